@@ -1,6 +1,9 @@
 #coding=utf-8
+import os
+import hashlib
+import dgl
 import torch
-from dgl import save_graphs
+import numpy as np
 from joblib import Parallel, delayed, cpu_count
 
 
@@ -12,39 +15,202 @@ def pmap(pickleable_fn, data, n_jobs=None, verbose=1, **kwargs):
         delayed(pickleable_fn)(d, **kwargs) for d in data
     )
 
+def _pack_strings(strings):
+    """Encode strings as one UTF-8 byte buffer plus offsets (length n + 1)."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def _unpack_strings(buffer, offsets):
+    data = bytes(buffer)
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+class PackedGraphs(object):
+    """All molecules of a dataset stored as concatenated arrays.
+
+    Node/edge features are stacked along the first axis; `src`/`dst` hold
+    dataset-global node ids and `node_offsets`/`edge_offsets` (length n + 1)
+    mark where each molecule starts. Slicing returns views, so a batch can be
+    cut without copying features.
+    """
+    __slots__ = ('node_feats', 'edge_feats', 'src', 'dst', 'node_offsets', 'edge_offsets')
+
+    def __init__(self, node_feats, edge_feats, src, dst, node_offsets, edge_offsets):
+        self.node_feats = node_feats
+        self.edge_feats = edge_feats
+        self.src = src
+        self.dst = dst
+        self.node_offsets = node_offsets
+        self.edge_offsets = edge_offsets
+
+    @classmethod
+    def from_graphs(cls, graphs):
+        node_feats, edge_feats, src, dst = {}, {}, [], []
+        node_offsets, edge_offsets = [0], [0]
+        for g in graphs:
+            u, v = g.edges()
+            src.append(u.numpy().astype(np.int64) + node_offsets[-1])
+            dst.append(v.numpy().astype(np.int64) + node_offsets[-1])
+            for name, feat in g.ndata.items():
+                node_feats.setdefault(name, []).append(feat.numpy())
+            for name, feat in g.edata.items():
+                edge_feats.setdefault(name, []).append(feat.numpy())
+            node_offsets.append(node_offsets[-1] + g.num_nodes())
+            edge_offsets.append(edge_offsets[-1] + g.num_edges())
+        return cls({name: np.concatenate(f) for name, f in node_feats.items()},
+                   {name: np.concatenate(f) for name, f in edge_feats.items()},
+                   np.concatenate(src) if src else np.zeros(0, dtype=np.int64),
+                   np.concatenate(dst) if dst else np.zeros(0, dtype=np.int64),
+                   np.asarray(node_offsets, dtype=np.int64),
+                   np.asarray(edge_offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.node_offsets) - 1
+
+    @property
+    def num_nodes(self):
+        return int(self.node_offsets[-1] - self.node_offsets[0])
+
+    def slice(self, start, stop):
+        n0, n1 = self.node_offsets[start], self.node_offsets[stop]
+        e0, e1 = self.edge_offsets[start], self.edge_offsets[stop]
+        return PackedGraphs({name: f[n0:n1] for name, f in self.node_feats.items()},
+                            {name: f[e0:e1] for name, f in self.edge_feats.items()},
+                            self.src[e0:e1], self.dst[e0:e1],
+                            self.node_offsets[start:stop + 1], self.edge_offsets[start:stop + 1])
+
+    def to_dgl(self):
+        """Build one batched DGLGraph for the molecules in this (slice of) pack."""
+        n0 = self.node_offsets[0]
+        src = torch.from_numpy(np.subtract(self.src, n0, dtype=np.int64))
+        dst = torch.from_numpy(np.subtract(self.dst, n0, dtype=np.int64))
+        bg = dgl.graph((src, dst), num_nodes=self.num_nodes)
+        bg.set_batch_num_nodes(torch.from_numpy(np.diff(self.node_offsets)))
+        bg.set_batch_num_edges(torch.from_numpy(np.diff(self.edge_offsets)))
+        for name, feat in self.node_feats.items():
+            bg.ndata[name] = torch.from_numpy(np.ascontiguousarray(feat))
+        for name, feat in self.edge_feats.items():
+            bg.edata[name] = torch.from_numpy(np.ascontiguousarray(feat))
+        return bg
+
+    def save(self, path, **extra):
+        """Write every array as .npy under `path` so `load` can memory-map them."""
+        os.makedirs(path, exist_ok=True)
+        arrays = dict(extra, src=self.src, dst=self.dst,
+                      node_offsets=self.node_offsets, edge_offsets=self.edge_offsets)
+        arrays.update({'ndata.' + name: f for name, f in self.node_feats.items()})
+        arrays.update({'edata.' + name: f for name, f in self.edge_feats.items()})
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """Returns (packed, extra) with arrays memory-mapped copy-on-write."""
+        arrays = {f[:-len('.npy')]: np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+                  for f in os.listdir(path) if f.endswith('.npy')}
+        packed = cls({k[len('ndata.'):]: arrays.pop(k) for k in list(arrays) if k.startswith('ndata.')},
+                     {k[len('edata.'):]: arrays.pop(k) for k in list(arrays) if k.startswith('edata.')},
+                     arrays.pop('src'), arrays.pop('dst'),
+                     arrays.pop('node_offsets'), arrays.pop('edge_offsets'))
+        return packed, arrays
+
 class Dataset(object):
     def __init__(self, df, smiles_to_graph, node_featurizer, edge_featurizer, smiles_column,
-                 cache_file_path, log_every=100):
+                 cache_file_path, log_every=100, screen=None, mol_to_graph=None):
         self.df = df
         self.smiles = self.df[smiles_column].tolist()
         self.task_names = self.df.columns.drop([smiles_column]).tolist()
         self.n_tasks = len(self.task_names)
         self.cache_file_path = cache_file_path
+        self.screen = screen
+        # used instead of smiles_to_graph when screening, on the mol the screen already parsed
+        self.mol_to_graph = mol_to_graph
         self._pre_process(smiles_to_graph, node_featurizer, edge_featurizer, log_every)
 
     def _pre_process(self, smiles_to_graph, node_featurizer,
                      edge_featurizer, log_every):
 
-        self.graphs = []
-        for i, s in enumerate(self.smiles):
-            if (i + 1) % log_every == 0:
-                print('Processing molecule {:d}/{:d}'.format(i+1, len(self)))
-            self.graphs.append(smiles_to_graph(s, node_featurizer=node_featurizer, edge_featurizer=edge_featurizer))
-        self.valid_ids = []
-        graphs = []
-        for i, g in enumerate(self.graphs):
-            if g is not None:
-                self.valid_ids.append(i)
-                graphs.append(g)
-        self.graphs = graphs
-        self.mol_idx = [self.df[self.task_names].values[i] for i in self.valid_ids]
-        valid_ids = torch.tensor(self.valid_ids)
-        save_graphs(self.cache_file_path, self.graphs, labels={'valid_ids': valid_ids})
+        if self.cache_file_path is not None and os.path.isdir(self.cache_file_path) and self._load_cache():
+            print('Loaded featurized molecules from {}'.format(self.cache_file_path))
+        else:
+            self._featurize(smiles_to_graph, node_featurizer, edge_featurizer, log_every)
+        self.labels = self.df[self.task_names].values[self.valid_ids]
         self.smiles = [self.smiles[i] for i in self.valid_ids]
 
+    def _featurize(self, smiles_to_graph, node_featurizer, edge_featurizer, log_every):
+        n_total = len(self.smiles)
+        self.valid_ids = []
+        # index -> reason for molecules rejected by the pre-screen or featurizer
+        self.rejections = {}
+
+        def valid_graphs():
+            for i, s in enumerate(self.smiles):
+                if (i + 1) % log_every == 0:
+                    print('Processing molecule {:d}/{:d}'.format(i+1, n_total))
+                if self.screen is not None:
+                    g, reason = self.screen.featurize(self.mol_to_graph, s, node_featurizer=node_featurizer, edge_featurizer=edge_featurizer)
+                    if reason is not None:
+                        self.rejections[i] = reason
+                else:
+                    g = smiles_to_graph(s, node_featurizer=node_featurizer, edge_featurizer=edge_featurizer)
+                if g is not None:
+                    self.valid_ids.append(i)
+                    yield g
+
+        self.packed = PackedGraphs.from_graphs(valid_graphs())
+        if self.cache_file_path is None:
+            return
+        # timeouts depend on machine load, so a later run may featurize those molecules
+        if any(self.screen.is_transient(reason) for reason in self.rejections.values()):
+            print('Not caching {}: some molecules hit the featurization time budget'.format(self.cache_file_path))
+            return
+        rejected_ids = sorted(self.rejections)
+        reasons, reason_offsets = _pack_strings(self.rejections[i] for i in rejected_ids)
+        self.packed.save(self.cache_file_path,
+                         valid_ids=np.asarray(self.valid_ids, dtype=np.int64),
+                         digest=self._cache_digest(),
+                         rejected_ids=np.asarray(rejected_ids, dtype=np.int64),
+                         rejection_reasons=reasons,
+                         rejection_offsets=reason_offsets)
+
+    def _screen_signature(self):
+        return self.screen.signature() if self.screen is not None else ''
+
+    def _cache_digest(self):
+        """SHA-256 of the screen limits and input SMILES; identifies the input a cache was built from."""
+        h = hashlib.sha256(self._screen_signature().encode('utf-8'))
+        for s in self.smiles:
+            h.update(b'\0')
+            h.update(s.encode('utf-8'))
+        return np.frombuffer(h.digest(), dtype=np.uint8)
+
+    def _load_cache(self):
+        """Reuses the memory-mapped cache if its digest matches the current SMILES and screen limits."""
+        try:
+            packed, extra = PackedGraphs.load(self.cache_file_path)
+            if not np.array_equal(extra['digest'], self._cache_digest()):
+                return False
+            reasons = _unpack_strings(extra['rejection_reasons'], extra['rejection_offsets'])
+            self.packed = packed
+            self.valid_ids = extra['valid_ids'].tolist()
+            self.rejections = dict(zip(extra['rejected_ids'].tolist(), reasons))
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def batches(self, batch_size):
+        """Yields (smiles, batched graph, labels) cut directly from the packed arrays."""
+        batch_size = max(batch_size, 1)
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            bg = self.packed.slice(start, stop).to_dgl()
+            bg.set_n_initializer(dgl.init.zero_initializer)
+            bg.set_e_initializer(dgl.init.zero_initializer)
+            yield self.smiles[start:stop], bg, self.labels[start:stop]
+
     def __getitem__(self, item):
-        return self.smiles[item], self.graphs[item], self.mol_idx[item]
+        return self.smiles[item], self.packed.slice(item, item + 1).to_dgl(), self.labels[item]
 
     def __len__(self):
         return len(self.smiles)
-
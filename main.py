@@ -4,8 +4,8 @@ import torch
 import numpy as np
 import pandas as pd
 from argparse import ArgumentParser
-from torch.utils.data import DataLoader
 from utils import init_featurizer,  load_dataset, get_self_configure, mkdir_p, collate_molgraphs, load_model, predict, read_fasta
+from screening import MoleculeScreen
 import shutil
 
 def prediction(args, exp_config, data_set):
@@ -14,14 +14,12 @@ def prediction(args, exp_config, data_set):
         'n_tasks': args['n_tasks'],
         'atom_featurizer_type': args['atom_featurizer_type'],
         'bond_featurizer_type': args['bond_featurizer_type']})
-    test_loader = DataLoader(dataset=data_set, batch_size=len(data_set), collate_fn=collate_molgraphs, num_workers=0)
     model = load_model(exp_config).to(args['device'])
     model.load_state_dict(torch.load(args['model_data_path']+'/model.pth', map_location=args['device'])['model_state_dict'])
     result = {'id': [], 'smiles': [], 'pre': []}
     model.eval()
     with torch.no_grad():
-        for batch_id, batch_data in enumerate(test_loader):
-            smiles, bg, idx = batch_data
+        for smiles, bg, idx in data_set.batches(args.get('batch_size') or len(data_set)):
             logits = predict(args, model, bg)
             proba = torch.sigmoid(logits).squeeze(1)
             result['id'].extend(np.array(idx).squeeze(1))
@@ -29,7 +27,7 @@ def prediction(args, exp_config, data_set):
             result['pre'].extend((proba.detach().cpu().data > exp_config['t1']).int().numpy())
     return result
 
-def model_run(data_file, root_model_folder, task_type, output_data_folder):
+def model_run(data_file, root_model_folder, task_type, output_data_folder, batch_size=None, cache_path=None):
 
     pretrain_folder_path = root_model_folder + task_type + '/'
 
@@ -43,6 +41,9 @@ def model_run(data_file, root_model_folder, task_type, output_data_folder):
             }
     args = init_featurizer(args)
     args['device'] = torch.device('cpu')
+    args['screen'] = MoleculeScreen.from_env()
+    args['batch_size'] = batch_size
+    args['cache_path'] = cache_path
     args['task_names'] = [args['task_names']]
     trans_mol, dataset = read_fasta(args, data_file)
     args['n_tasks'] = dataset.n_tasks
@@ -53,6 +54,9 @@ def model_run(data_file, root_model_folder, task_type, output_data_folder):
     result['id'].extend(np.array(trans_mol['id'])[args['invalid_mol_ids']])
     result['smiles'].extend(np.array(trans_mol['SMILES'])[args['invalid_mol_ids']])
     result['pre'].extend(['invalid mol']*len(args['invalid_mol_ids']))
+    # rejection reason for invalid molecules (empty for valid rows)
+    result['reason'] = [''] * (len(result['id']) - len(args['invalid_mol_ids']))
+    result['reason'].extend(dataset.rejections.get(i, 'featurization failed') for i in args['invalid_mol_ids'])
 
     result_df = pd.DataFrame(result)
     result_df.to_csv(output_data_folder+'result.csv', index=False)
@@ -60,10 +64,45 @@ def model_run(data_file, root_model_folder, task_type, output_data_folder):
 
     print('###PREDICTION OVER!###\n')
 
+def store_backfill(data_file, root_model_folder, task_types, store_path, rescore=False):
+    from microservice.core.prediction_service import ToxicityPredictionService
+    from microservice.core.prediction_store import PredictionStore
+
+    service = ToxicityPredictionService(model_root=root_model_folder)
+    store = PredictionStore(store_path, model_root=root_model_folder)
+    task_types = task_types or service.available_tasks()
+    if rescore:
+        scored = store.rescore_stale(service, task_types)
+    else:
+        with open(data_file, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        smiles = [lines[flag + 1].strip() for flag in range(0, len(lines) - 1, 2)]
+        scored = store.backfill(service, smiles, task_types)
+    for task, count in scored.items():
+        print('{}: {:d} molecules scored'.format(task, count))
+
+    print('###BACKFILL OVER!###\n')
+
+def embed_run(data_file, root_model_folder, task_types, embedding_path):
+    from microservice.core.prediction_service import ToxicityPredictionService
+    from microservice.core.embedding_store import EmbeddingStore
+
+    service = ToxicityPredictionService(model_root=root_model_folder)
+    store = EmbeddingStore(embedding_path, model_root=root_model_folder)
+    task_types = task_types or service.available_tasks()
+    with open(data_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    smiles = [lines[flag + 1].strip() for flag in range(0, len(lines) - 1, 2)]
+    stored = store.backfill(service, smiles, task_types)
+    for task, count in stored.items():
+        print('{}: {:d} embeddings written to {}'.format(task, count, os.path.join(embedding_path, task)))
+
+    print('###EMBEDDING OVER!###\n')
+
 
 if __name__ == '__main__':
     parser = ArgumentParser('Prediction Script for SSL-GCN models')
-    parser.add_argument('-d', '--data-path', type=str, required=True, help='The path to the data folder (with "/" or "\\" at the end)')
+    parser.add_argument('-d', '--data-path', type=str, default=None, help='The path to the data folder (with "/" or "\\" at the end)')
     parser.add_argument('-m', '--model-path', type=str, required=True, help='The path to the model folder (with "/" or "\\" at the end)')
     parser.add_argument('-t', '--task_type',
                         choices=['NR-AR', 'NR-AR-LBD', 'NR-AhR', 'NR-Aromatase',
@@ -71,8 +110,26 @@ if __name__ == '__main__':
                                  'SR-ATAD5', 'SR-HSE', 'SR-MMP', 'SR-p53'],
                         help='define the 1 of 12 toxicity endpoints.')
     parser.add_argument('-o', '--output-path', default=None, type=str, help='The path to an empty output folder where the experiment results will be stored (with "/" or "\\" at the end)')
+    parser.add_argument('-b', '--batch-size', default=None, type=int, help='Number of molecules per inference micro-batch (default: the whole file at once)')
+    parser.add_argument('-s', '--store-path', default=None, type=str, help='Backfill the persistent prediction store at this path instead of writing result.csv (all endpoints unless -t is given)')
+    parser.add_argument('--rescore', action='store_true', help='With -s, only re-score endpoints whose model.pth changed since they were stored')
+    parser.add_argument('-c', '--cache-path', default=None, type=str, help='Folder for the memory-mapped featurization cache; reused instead of re-featurizing when it was built from the same data file')
+    parser.add_argument('-e', '--embedding-path', default=None, type=str, help='Write graph readout embeddings to the memory-mapped store at this folder (all endpoints unless -t is given)')
     start_args = parser.parse_args().__dict__
-    model_run(start_args['data_path'], start_args['model_path'], start_args['task_type'], start_args['output_path'])
+    if start_args['embedding_path'] is not None:
+        if start_args['data_path'] is None:
+            parser.error('-d/--data-path is required')
+        task_types = [start_args['task_type']] if start_args['task_type'] else None
+        embed_run(start_args['data_path'], start_args['model_path'], task_types, start_args['embedding_path'])
+    elif start_args['store_path'] is not None:
+        if not start_args['rescore'] and start_args['data_path'] is None:
+            parser.error('-d/--data-path is required unless --rescore is given')
+        task_types = [start_args['task_type']] if start_args['task_type'] else None
+        store_backfill(start_args['data_path'], start_args['model_path'], task_types, start_args['store_path'], start_args['rescore'])
+    else:
+        if start_args['data_path'] is None:
+            parser.error('-d/--data-path is required')
+        model_run(start_args['data_path'], start_args['model_path'], start_args['task_type'], start_args['output_path'], start_args['batch_size'], start_args['cache_path'])
 
 
 
@@ -1,15 +1,23 @@
 #coding=utf-8
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request, Depends, Response
+from fastapi.responses import FileResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Tuple
 import uvicorn
 import os
+import time
 import sys
 
 # 添加項目根目錄到Python路徑
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 from microservice.core.prediction_service import ToxicityPredictionService
+from microservice.core.profiling import RequestProfiler
+from microservice.core.prediction_store import PredictionStore
+from microservice.core.embedding_store import EmbeddingStore
+from microservice.core.autotune import AutoTuner
+from microservice.core.scheduler import AdmissionScheduler
+from microservice.api import serialization
 
 app = FastAPI(
     title="SSL-GCN 毒性預測 API",
@@ -22,6 +30,29 @@ app = FastAPI(
 # 初始化預測服務
 prediction_service = ToxicityPredictionService()
 
+# 執行緒數與微批次大小自動校準（啟動時執行）
+auto_tuner = AutoTuner(prediction_service)
+
+# 互動/批量請求的成本感知准入排程器
+scheduler = AdmissionScheduler()
+
+# 按需請求剖析器（預設關閉，可由環境變數或管理端點啟用）
+request_profiler = RequestProfiler()
+ADMIN_TOKEN = os.environ.get('SSL_GCN_ADMIN_TOKEN')
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+# 預先計算的預測結果庫
+prediction_store = PredictionStore(
+    os.environ.get('SSL_GCN_PREDICTION_STORE', 'prediction_store.sqlite3'),
+    model_root=prediction_service.model_root
+)
+
+# 記憶體映射的圖嵌入庫
+embedding_store = EmbeddingStore(
+    os.environ.get('SSL_GCN_EMBEDDING_STORE', 'embeddings'),
+    model_root=prediction_service.model_root
+)
+
 # 請求模型
 class SinglePredictionRequest(BaseModel):
     molecule_id: str
@@ -32,6 +63,10 @@ class BatchPredictionRequest(BaseModel):
     molecules: List[Dict[str, str]]
     task_type: str
 
+class LookupRequest(BaseModel):
+    molecules: List[Dict[str, str]]
+    task_types: Optional[List[str]] = None
+
 # 回應模型
 class PredictionResponse(BaseModel):
     molecule_id: str
@@ -39,6 +74,31 @@ class PredictionResponse(BaseModel):
     prediction: str
     confidence: Optional[float] = None
     status: str
+    error_message: Optional[str] = None
+
+class EmbedRequest(BaseModel):
+    molecules: List[Dict[str, str]]
+    task_types: Optional[List[str]] = None
+
+class EndpointPrediction(BaseModel):
+    probability: Optional[float] = None
+    prediction: str
+
+class LookupResponse(BaseModel):
+    molecule_id: str
+    smiles: str
+    canonical_smiles: Optional[str] = None
+    predictions: Dict[str, EndpointPrediction]
+    status: str
+    error_message: Optional[str] = None
+
+class EmbedResponse(BaseModel):
+    molecule_id: str
+    smiles: str
+    canonical_smiles: Optional[str] = None
+    embeddings: Dict[str, Optional[List[float]]]
+    status: str
+    error_message: Optional[str] = None
 
 class HealthResponse(BaseModel):
     status: str
@@ -51,6 +111,95 @@ class ModelInfoResponse(BaseModel):
     supported_tasks: List[str]
     description: str
 
+class TuningSettingsRequest(BaseModel):
+    intra_op_threads: Optional[int] = None
+    micro_batch_size: Optional[int] = None
+
+class ProfilingSettingsRequest(BaseModel):
+    enabled: Optional[bool] = None
+    sample_rate: Optional[float] = None
+
+def _check_admin(http_request: Request, x_admin_token: Optional[str] = Header(None)) -> None:
+    """管理端點權限：設定 SSL_GCN_ADMIN_TOKEN 時需附上相符的 X-Admin-Token；
+    未設定時只接受本機（loopback）請求，避免任何客戶端都能調整剖析或副本設定"""
+    if ADMIN_TOKEN:
+        if x_admin_token != ADMIN_TOKEN:
+            raise HTTPException(status_code=403, detail="管理權杖無效")
+    elif not (http_request.client and http_request.client.host in LOOPBACK_HOSTS):
+        raise HTTPException(status_code=403, detail="未設定 SSL_GCN_ADMIN_TOKEN 時管理端點僅限本機存取")
+
+def _profile_requested(x_profile: Optional[str]) -> bool:
+    return bool(x_profile) and x_profile.lower() in ('1', 'true', 'yes')
+
+def _client_id(http_request: Request) -> str:
+    """公平分享的客戶識別：X-API-Key，其次 X-Client-Id，最後為來源位址"""
+    headers = http_request.headers
+    return (headers.get('x-api-key') or headers.get('x-client-id')
+            or (http_request.client.host if http_request.client else 'anonymous'))
+
+async def _schedule(http_request: Request, molecules: List[Dict[str, str]],
+                    fn: Callable[[List[Dict[str, str]]], List[Any]],
+                    render: Optional[Callable[[List[Any]], Response]] = None,
+                    interactive: bool = False, weight: float = 1.0,
+                    **profile_meta) -> Tuple[Any, Dict[str, str]]:
+    """經排程器執行 fn，回傳 (結果或 render 編碼的回應, 回應標頭)
+
+    剖析中的請求照常切片，只剖析第一個切片，合併後的回應編碼時間另行補記為 serialize 階段。
+    weight 為每個分子的工作量倍數（多端點請求為端點數）。
+    """
+    profile = request_profiler.should_profile(_profile_requested(http_request.headers.get('x-profile')))
+    trace = {}
+    # 切片依序在單一工作執行緒上執行，第一個取出旗標的即為第一個切片
+    pending_profile = [True] if profile else []
+
+    def sliced(molecules):
+        active = bool(pending_profile) and pending_profile.pop()
+        with request_profiler.profile(active, scope='first_slice', **profile_meta) as session:
+            if session is not None:
+                trace['id'] = session.trace_id
+            return fn(molecules)
+
+    results, wait, lane = await scheduler.run(_client_id(http_request), molecules, sliced,
+                                              interactive=interactive, weight=weight,
+                                              min_slice=prediction_service.micro_batch_size or 1)
+    if render is not None:
+        start = time.perf_counter()
+        results = render(results)
+        if 'id' in trace:
+            request_profiler.record_stage(trace['id'], 'serialize', time.perf_counter() - start)
+    headers = {"X-Queue-Wait-Ms": f"{wait * 1000:.1f}", "X-Scheduler-Lane": lane}
+    if 'id' in trace:
+        headers["X-Profile-Trace-Id"] = trace['id']
+    return results, headers
+
+def _negotiate(accept: Optional[str]) -> str:
+    try:
+        return serialization.negotiate(accept)
+    except serialization.NotAcceptableError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+# 熱門端點的回應欄位（直接編碼，不逐列經 response_model 驗證）
+PREDICTION_FIELDS = list(PredictionResponse.__fields__)
+LOOKUP_FIELDS = list(LookupResponse.__fields__)
+EMBED_FIELDS = list(EmbedResponse.__fields__)
+
+@app.on_event("startup")
+async def calibrate_runtime():
+    """啟動時校準 torch 執行緒數與微批次大小（SSL_GCN_AUTOTUNE=0 可停用）"""
+    if os.environ.get('SSL_GCN_AUTOTUNE', '1').lower() in ('0', 'false', 'no'):
+        return
+    # 在推論所用的工作執行緒上校準，torch 執行緒設定才會套用到實際推論
+    await scheduler.call(auto_tuner.run)
+
+@app.on_event("startup")
+async def start_scheduler():
+    """啟動准入排程器的派送工作"""
+    scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+
 @app.get("/", response_model=Dict[str, str])
 async def root():
     """根端點"""
@@ -80,30 +229,104 @@ async def get_model_info():
     }
 
 @app.post("/predict/single", response_model=PredictionResponse)
-async def predict_single(request: SinglePredictionRequest):
+async def predict_single(request: SinglePredictionRequest, http_request: Request, response: Response):
     """單一分子毒性預測"""
     try:
-        result = prediction_service.predict_single(
-            molecule_id=request.molecule_id,
-            smiles=request.smiles,
+        results, headers = await _schedule(
+            http_request,
+            [{'molecule_id': request.molecule_id, 'smiles': request.smiles}],
+            lambda molecules: [prediction_service.predict_single(
+                molecule_id=request.molecule_id,
+                smiles=request.smiles,
+                task_type=request.task_type
+            )],
+            interactive=True,
+            endpoint="/predict/single",
             task_type=request.task_type
         )
-        return result
+        response.headers.update(headers)
+        return results[0]
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/predict/batch", response_model=List[PredictionResponse])
-async def predict_batch(request: BatchPredictionRequest):
-    """批次分子毒性預測"""
+async def predict_batch(request: BatchPredictionRequest, http_request: Request,
+                        accept: Optional[str] = Header(None)):
+    """批次分子毒性預測（依 Accept 標頭回傳 JSON、欄式 JSON 或 MessagePack）"""
+    media_type = _negotiate(accept)
     try:
-        results = prediction_service.predict_batch(
-            molecules=request.molecules,
+        prediction_service._validate_task_type(request.task_type)
+        if not request.molecules:
+            raise ValueError("分子列表不能為空")
+        response, headers = await _schedule(
+            http_request,
+            request.molecules,
+            lambda molecules: prediction_service.predict_batch(
+                molecules=molecules,
+                task_type=request.task_type
+            ),
+            render=lambda results: serialization.render(results, PREDICTION_FIELDS, media_type),
+            endpoint="/predict/batch",
             task_type=request.task_type
         )
-        return results
+        response.headers.update(headers)
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/predict/lookup", response_model=List[LookupResponse])
+async def predict_lookup(request: LookupRequest, http_request: Request,
+                         accept: Optional[str] = Header(None)):
+    """多端點批次查詢：優先讀取預測結果庫，只計算未命中的分子"""
+    media_type = _negotiate(accept)
+    try:
+        task_types = request.task_types or prediction_service.available_tasks()
+        for task_type in task_types:
+            prediction_service._validate_task_type(task_type)
+        if not request.molecules:
+            raise ValueError("分子列表不能為空")
+        response, headers = await _schedule(
+            http_request,
+            request.molecules,
+            lambda molecules: prediction_store.bulk_lookup(prediction_service, molecules, task_types),
+            render=lambda results: serialization.render(results, LOOKUP_FIELDS, media_type),
+            weight=len(task_types),
+            endpoint="/predict/lookup"
+        )
+        response.headers.update(headers)
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/embed", response_model=List[EmbedResponse])
+async def embed_batch(request: EmbedRequest, http_request: Request,
+                      accept: Optional[str] = Header(None)):
+    """批次擷取各端點 GCN 的圖層級讀出向量（優先讀取嵌入庫）"""
+    media_type = _negotiate(accept)
+    try:
+        task_types = request.task_types or prediction_service.available_tasks()
+        for task_type in task_types:
+            prediction_service._validate_task_type(task_type)
+        if not request.molecules:
+            raise ValueError("分子列表不能為空")
+        response, headers = await _schedule(
+            http_request,
+            request.molecules,
+            lambda molecules: embedding_store.bulk_embed(prediction_service, molecules, task_types),
+            render=lambda results: serialization.render(results, EMBED_FIELDS, media_type),
+            weight=len(task_types),
+            endpoint="/embed"
+        )
+        response.headers.update(headers)
+        return response
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/admin/store", response_model=Dict[str, Any], dependencies=[Depends(_check_admin)])
+async def get_store_stats():
+    """獲取預測結果庫統計"""
+    return prediction_store.stats()
+
 @app.get("/predict/tasks", response_model=List[str])
 async def get_supported_tasks():
     """獲取支援的毒性端點列表"""
@@ -113,6 +336,56 @@ async def get_supported_tasks():
         "SR-ATAD5", "SR-HSE", "SR-MMP", "SR-p53"
     ]
 
+@app.get("/admin/scheduler", response_model=Dict[str, Any], dependencies=[Depends(_check_admin)])
+async def get_scheduler_stats():
+    """獲取排程器各通道的佇列深度與佇列等待時間"""
+    return scheduler.stats()
+
+@app.get("/admin/tuning", response_model=Dict[str, Any], dependencies=[Depends(_check_admin)])
+async def get_tuning_settings():
+    """獲取目前的執行緒與微批次設定及校準結果"""
+    return auto_tuner.settings
+
+@app.put("/admin/tuning", response_model=Dict[str, Any], dependencies=[Depends(_check_admin)])
+async def update_tuning_settings(request: TuningSettingsRequest):
+    """手動覆寫 intra-op 執行緒數或微批次大小"""
+    try:
+        settings = await scheduler.call(
+            lambda: auto_tuner.apply(request.intra_op_threads, request.micro_batch_size))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    settings['source'] = 'manual'
+    return settings
+
+@app.get("/admin/profiling", response_model=Dict[str, Any], dependencies=[Depends(_check_admin)])
+async def get_profiling_settings():
+    """獲取請求剖析設定"""
+    return request_profiler.settings()
+
+@app.put("/admin/profiling", response_model=Dict[str, Any], dependencies=[Depends(_check_admin)])
+async def update_profiling_settings(request: ProfilingSettingsRequest):
+    """啟用/停用請求剖析或調整取樣率"""
+    try:
+        return request_profiler.configure(enabled=request.enabled, sample_rate=request.sample_rate)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/admin/profiles", response_model=List[Dict[str, Any]], dependencies=[Depends(_check_admin)])
+async def list_profiles(limit: int = 20):
+    """列出最近的剖析追蹤"""
+    return request_profiler.list_traces(limit)
+
+@app.get("/admin/profiles/{trace_id}", dependencies=[Depends(_check_admin)])
+async def get_profile(trace_id: str, artifact: str = "meta"):
+    """下載剖析追蹤檔案（meta / cprofile / cprofile_text / torch）"""
+    try:
+        path = request_profiler.artifact_path(trace_id, artifact)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FileResponse(path, filename=f"{trace_id}-{os.path.basename(path)}")
+
 if __name__ == "__main__":
     uvicorn.run(
         "microservice.api.app:app",
@@ -0,0 +1,103 @@
+#coding=utf-8
+import json
+from typing import List, Dict, Any, Optional, Sequence
+
+import numpy as np
+from fastapi import Response
+
+# 可選的高效能編碼器，未安裝時退回標準 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+COLUMNAR_MEDIA_TYPE = "application/vnd.ssl-gcn.columnar+json"
+
+# 接受的別名 -> 標準媒體類型
+_MEDIA_ALIASES = {
+    JSON_MEDIA_TYPE: JSON_MEDIA_TYPE,
+    "application/*": JSON_MEDIA_TYPE,
+    "*/*": JSON_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE: MSGPACK_MEDIA_TYPE,
+    "application/x-msgpack": MSGPACK_MEDIA_TYPE,
+    COLUMNAR_MEDIA_TYPE: COLUMNAR_MEDIA_TYPE,
+}
+
+
+class NotAcceptableError(ValueError):
+    """Accept 標頭中沒有可提供的媒體類型"""
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """依 Accept 標頭（含 q 值）選擇回應格式，未指定時為 JSON"""
+    if not accept:
+        return JSON_MEDIA_TYPE
+    candidates = []
+    for order, part in enumerate(accept.split(",")):
+        media, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        media = _MEDIA_ALIASES.get(media.lower())
+        if media is None or quality <= 0:
+            continue
+        if media == MSGPACK_MEDIA_TYPE and msgpack is None:
+            continue
+        candidates.append((-quality, order, media))
+    if not candidates:
+        raise NotAcceptableError(
+            f"不支援的回應格式: {accept}。支援的格式: {JSON_MEDIA_TYPE}, {COLUMNAR_MEDIA_TYPE}"
+            + (f", {MSGPACK_MEDIA_TYPE}" if msgpack is not None else "")
+        )
+    return min(candidates)[2]
+
+
+def _default(obj: Any) -> Any:
+    """numpy 純量與陣列轉為原生型別"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"無法序列化的型別: {type(obj).__name__}")
+
+
+def dumps_json(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def dumps_msgpack(obj: Any) -> bytes:
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def project_rows(rows: List[Dict[str, Any]], fields: Sequence[str]) -> List[Dict[str, Any]]:
+    """只保留回應模型欄位，取代逐列的 pydantic 驗證"""
+    return [{field: row.get(field) for field in fields} for row in rows]
+
+
+def to_columns(rows: List[Dict[str, Any]], fields: Sequence[str]) -> Dict[str, List[Any]]:
+    """轉為欄式格式（每個欄位一個平行陣列）"""
+    return {field: [row.get(field) for row in rows] for field in fields}
+
+
+def render(rows: List[Dict[str, Any]], fields: Sequence[str], media_type: str) -> Response:
+    """依協商結果編碼回應，略過 FastAPI 的 response_model 驗證"""
+    if media_type == COLUMNAR_MEDIA_TYPE:
+        content = dumps_json(to_columns(rows, fields))
+    elif media_type == MSGPACK_MEDIA_TYPE:
+        content = dumps_msgpack(project_rows(rows, fields))
+    else:
+        content = dumps_json(project_rows(rows, fields))
+    return Response(content=content, media_type=media_type, headers={"Vary": "Accept"})
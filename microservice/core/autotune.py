@@ -0,0 +1,214 @@
+#coding=utf-8
+import os
+import time
+import shutil
+import tempfile
+from typing import List, Dict, Any, Optional, Tuple
+
+import torch
+
+from utils import get_self_configure, predict
+
+# 校準用的代表性分子（取自 Tox21 類藥分子），重複組成合成批次
+CALIBRATION_SMILES = [
+    'O=C1Cc2cc(CCN3CCN(c4nsc5ccccc45)CC3)c(Cl)cc2N1',
+    'CN(C)CCOC1=Cc2ccccc2Sc2ccc(Cl)cc21',
+    'COc1cc(OC)nc(NC(=O)NS(=O)(=O)c2ncccc2C(=O)N(C)C)n1',
+    'COC1=CC(=O)OC(CCc2ccccc2)C1',
+    'C[C@@H](Cc1ccccc1)NCCC(c1ccccc1)c1ccccc1.C[C@H](O)C(=O)O',
+    'CCCc1ncc(C[n+]2ccccc2C)c(N)n1',
+    'C[N+]1(CCCCC[N+]2(C)CCCC2)CCCC1',
+    'CC1(C)CCC(=Cc2ccc(Cl)cc2)C1(O)Cn1cncn1',
+    'CC(=O)Oc1ccccc1C(=O)O',
+    'CCO',
+]
+
+BATCH_SIZE_CANDIDATES = [32, 64, 128, 256, 512, 1024]
+# 吞吐量落在最佳值此比例內時，優先選擇較少執行緒與較小批次
+TOLERANCE = 0.95
+
+
+def _cgroup_quota() -> Optional[float]:
+    """cgroup CPU 配額（核心數），依序檢查 cgroup v2 與 v1；無限制時回傳 None"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def available_cores() -> int:
+    """偵測可用 CPU 核心數（考慮 CPU 親和性與 cgroup 配額）"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = _cgroup_quota()
+    if quota is not None:
+        cores = min(cores, max(1, int(quota)))
+    return max(1, cores)
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+class AutoTuner:
+    """啟動時校準 torch 執行緒數與微批次大小
+
+    以常駐模型對合成分子批次做基準測試，選出吞吐量最佳的 intra-op 執行緒數與
+    微批次大小。SSL_GCN_INTRA_OP_THREADS、SSL_GCN_INTER_OP_THREADS 與
+    SSL_GCN_MICRO_BATCH_SIZE 可手動覆寫對應設定；覆寫的項目不再校準。
+    inter-op 執行緒數只能在任何平行工作開始前設定一次，因此不參與基準測試。
+    """
+
+    def __init__(self, service, budget_seconds: Optional[float] = None):
+        self.service = service
+        self.budget_seconds = float(budget_seconds if budget_seconds is not None
+                                    else os.environ.get('SSL_GCN_AUTOTUNE_BUDGET', '10'))
+        self.cores = available_cores()
+        self.settings: Dict[str, Any] = {
+            'cores': self.cores,
+            'intra_op_threads': torch.get_num_threads(),
+            'inter_op_threads': None,
+            'micro_batch_size': service.micro_batch_size,
+            'source': 'default',
+            'benchmarks': [],
+            'truncated': False,
+        }
+
+    def _thread_candidates(self) -> List[int]:
+        candidates = {1, self.cores}
+        n = 2
+        while n < self.cores:
+            candidates.add(n)
+            n *= 2
+        return sorted(candidates)
+
+    def _set_inter_op_threads(self, n: int) -> None:
+        try:
+            torch.set_num_interop_threads(n)
+        except RuntimeError:
+            # 已有平行工作開始後無法再變更
+            pass
+        self.settings['inter_op_threads'] = torch.get_num_interop_threads()
+
+    def _measure(self, args, model, dataset, threads: int, batch_size: int) -> Dict[str, Any]:
+        """量測一組 (執行緒數, 批次大小) 的推論吞吐量（分子/秒）"""
+        torch.set_num_threads(threads)
+        # 預熱一次後計時
+        for _, bg, _ in dataset.batches(batch_size):
+            predict(args, model, bg)
+            break
+        start = time.perf_counter()
+        for _, bg, _ in dataset.batches(batch_size):
+            predict(args, model, bg)
+        elapsed = time.perf_counter() - start
+        return {'intra_op_threads': threads, 'micro_batch_size': batch_size,
+                'molecules_per_second': len(dataset) / elapsed if elapsed > 0 else 0.0}
+
+    def _benchmark(self, task: str, thread_candidates: List[int],
+                   batch_candidates: List[int]) -> Tuple[Dict[str, Any], List[Dict[str, Any]], bool]:
+        """先以最多執行緒選出微批次大小，再以該批次大小掃描全部執行緒數
+
+        時間預算各分一半給兩個階段，確保所有執行緒數都有機會量測；
+        回傳 (所選設定, 全部量測結果, 是否因預算用盡而中斷)。
+        """
+        n_molecules = max(batch_candidates)
+        molecules = [{'molecule_id': str(i), 'smiles': CALIBRATION_SMILES[i % len(CALIBRATION_SMILES)]}
+                     for i in range(n_molecules)]
+        temp_dir = tempfile.mkdtemp()
+        try:
+            args, _, dataset = self.service._load_molecules(molecules, task, temp_dir)
+            exp_config = get_self_configure(args['model_data_path'] + '/configure.json')
+            model = self.service._load_model(args, exp_config)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        start = time.perf_counter()
+        max_threads = max(thread_candidates)
+        other_threads = [t for t in thread_candidates if t != max_threads]
+        batch_deadline = start + (self.budget_seconds / 2 if other_threads else self.budget_seconds)
+        deadline = start + self.budget_seconds
+        truncated = False
+        with torch.no_grad():
+            batch_results = []
+            for batch_size in batch_candidates:
+                # 每階段至少量測一組
+                if batch_results and time.perf_counter() > batch_deadline:
+                    truncated = True
+                    break
+                batch_results.append(self._measure(args, model, dataset, max_threads, batch_size))
+            batch_size = self._choose(batch_results, 'micro_batch_size')['micro_batch_size']
+
+            thread_results = [r for r in batch_results if r['micro_batch_size'] == batch_size]
+            for threads in other_threads:
+                if time.perf_counter() > deadline:
+                    truncated = True
+                    break
+                thread_results.append(self._measure(args, model, dataset, threads, batch_size))
+            threads = self._choose(thread_results, 'intra_op_threads')['intra_op_threads']
+
+        results = batch_results + [r for r in thread_results if r['intra_op_threads'] != max_threads]
+        return {'intra_op_threads': threads, 'micro_batch_size': batch_size}, results, truncated
+
+    def _choose(self, results: List[Dict[str, Any]], key: str) -> Dict[str, Any]:
+        """吞吐量落在最佳值容差內的結果中，取 key 最小者"""
+        best = max(r['molecules_per_second'] for r in results)
+        good = [r for r in results if r['molecules_per_second'] >= TOLERANCE * best]
+        return min(good, key=lambda r: r[key])
+
+    def run(self, task: Optional[str] = None) -> Dict[str, Any]:
+        """執行校準並套用到 torch 與預測服務，回傳所選設定"""
+        intra_override = _env_int('SSL_GCN_INTRA_OP_THREADS')
+        inter_override = _env_int('SSL_GCN_INTER_OP_THREADS')
+        batch_override = _env_int('SSL_GCN_MICRO_BATCH_SIZE')
+
+        # 推論為單一串流，inter-op 平行度用處不大
+        self._set_inter_op_threads(inter_override or 1)
+
+        thread_candidates = [intra_override] if intra_override else self._thread_candidates()
+        batch_candidates = [batch_override] if batch_override else BATCH_SIZE_CANDIDATES
+        # 無法校準時：使用覆寫值，否則使用全部核心與不分批
+        chosen = {'intra_op_threads': intra_override or self.cores, 'micro_batch_size': batch_override}
+        source = 'override' if (intra_override or batch_override) else 'default'
+
+        tasks = self.service.available_tasks()
+        if (len(thread_candidates) > 1 or len(batch_candidates) > 1) and tasks:
+            try:
+                chosen, results, truncated = self._benchmark(task or tasks[0], thread_candidates, batch_candidates)
+                self.settings['benchmarks'] = results
+                # 預算用盡時部分組合未量測，所選設定可能不是最佳
+                self.settings['truncated'] = truncated
+                source = 'calibrated+override' if (intra_override or batch_override) else 'calibrated'
+            except Exception as e:
+                self.settings['benchmarks'] = []
+                self.settings['error'] = f"校準失敗: {str(e)}"
+
+        self.apply(chosen['intra_op_threads'], chosen['micro_batch_size'])
+        self.settings['source'] = source
+        return self.settings
+
+    def apply(self, intra_op_threads: Optional[int] = None, micro_batch_size: Optional[int] = None) -> Dict[str, Any]:
+        """套用設定（也供管理端點手動覆寫）"""
+        if intra_op_threads is not None:
+            if intra_op_threads < 1:
+                raise ValueError(f"執行緒數必須大於 0: {intra_op_threads}")
+            torch.set_num_threads(intra_op_threads)
+            self.settings['intra_op_threads'] = torch.get_num_threads()
+        if micro_batch_size is not None:
+            if micro_batch_size < 1:
+                raise ValueError(f"微批次大小必須大於 0: {micro_batch_size}")
+            self.service.micro_batch_size = micro_batch_size
+            self.settings['micro_batch_size'] = micro_batch_size
+        return self.settings
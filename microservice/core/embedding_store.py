@@ -0,0 +1,262 @@
+#coding=utf-8
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+from microservice.core.prediction_store import canonicalize_smiles, model_checksum
+
+
+class EmbeddingStore:
+    """記憶體映射的圖嵌入庫：每個端點一個 float32 矩陣，列以標準 SMILES 索引
+
+    目錄結構為 <root>/<task>/ 下的 embeddings.f32（原始 float32 矩陣）、
+    index.txt（每列對應的標準 SMILES）與 meta.json（維度、列數、模型校驗碼）。
+    模型權重變更時該端點的矩陣會被清空重建。多個行程（其他副本或 main.py -e）
+    可共用同一嵌入庫：寫入時持有 <task>/.lock 檔案鎖，並先以磁碟上的中繼資料
+    與索引更新本行程的快取。
+    """
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, root: str, model_root: str = "model"):
+        self.root = root
+        self.model_root = model_root
+        self._tables: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, task: str) -> Dict[str, str]:
+        task_dir = os.path.join(self.root, task)
+        return {
+            'dir': task_dir,
+            'matrix': os.path.join(task_dir, 'embeddings.f32'),
+            'index': os.path.join(task_dir, 'index.txt'),
+            'meta': os.path.join(task_dir, 'meta.json'),
+            'lock': os.path.join(task_dir, '.lock'),
+        }
+
+    @contextmanager
+    def _file_lock(self, task: str):
+        """跨行程的獨占寫入鎖"""
+        paths = self._paths(task)
+        os.makedirs(paths['dir'], exist_ok=True)
+        with open(paths['lock'], 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_meta(self, paths: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(paths['meta']):
+            return None
+        with open(paths['meta'], 'r') as f:
+            return json.load(f)
+
+    def _read_index(self, paths: Dict[str, str], meta: Dict[str, Any]) -> Dict[str, int]:
+        """讀取前 rows 列的索引；忽略未被中繼資料記錄的尾端"""
+        with open(paths['index'], 'r', encoding='utf-8') as f:
+            keys = [line.rstrip('\n') for line in f][:meta['rows']]
+        meta.setdefault('index_bytes', sum(len(key.encode('utf-8')) + 1 for key in keys))
+        return {key: row for row, key in enumerate(keys)}
+
+    def _map(self, paths: Dict[str, str], meta: Dict[str, Any]) -> np.memmap:
+        return np.memmap(paths['matrix'], dtype=np.float32, mode='r+', shape=(meta['capacity'], meta['dim']))
+
+    def _open(self, task: str, dim: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """開啟（必要時建立）端點的嵌入表；模型校驗碼不符時重置（建立與重置須持有檔案鎖）"""
+        checksum = model_checksum(self.model_root, task)
+        table = self._tables.get(task)
+        if table is not None and table['checksum'] == checksum:
+            return table
+
+        paths = self._paths(task)
+        meta = self._read_meta(paths)
+        if meta is None or meta['model_checksum'] != checksum:
+            if dim is None:
+                return None
+            os.makedirs(paths['dir'], exist_ok=True)
+            meta = {'dim': dim, 'rows': 0, 'capacity': self.INITIAL_CAPACITY,
+                    'index_bytes': 0, 'model_checksum': checksum}
+            # 以新檔案取代，其他行程仍映射中的舊矩陣不會被截斷
+            for name, size in (('matrix', meta['capacity'] * dim * 4), ('index', 0)):
+                with open(paths[name] + '.tmp', 'wb') as f:
+                    f.truncate(size)
+                os.replace(paths[name] + '.tmp', paths[name])
+            self._write_meta(paths, meta)
+
+        table = {
+            'checksum': checksum,
+            'meta': meta,
+            'paths': paths,
+            'index': self._read_index(paths, meta),
+            'matrix': self._map(paths, meta),
+        }
+        self._tables[task] = table
+        return table
+
+    def _sync(self, task: str, table: Dict[str, Any], dim: int) -> Dict[str, Any]:
+        """在檔案鎖內以磁碟上的中繼資料更新快取（其他行程可能已附加或重置）"""
+        paths = table['paths']
+        meta = self._read_meta(paths)
+        if meta is None or meta['model_checksum'] != table['checksum']:
+            self._tables.pop(task, None)
+            return self._open(task, dim)
+        if meta['rows'] != table['meta']['rows']:
+            table['index'] = self._read_index(paths, meta)
+        else:
+            meta.setdefault('index_bytes', table['meta']['index_bytes'])
+        if meta['capacity'] != table['meta']['capacity']:
+            del table['matrix']
+            table['matrix'] = self._map(paths, meta)
+        table['meta'] = meta
+        return table
+
+    def _write_meta(self, paths: Dict[str, str], meta: Dict[str, Any]) -> None:
+        tmp_path = paths['meta'] + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, paths['meta'])
+
+    def _grow(self, table: Dict[str, Any], needed_rows: int) -> None:
+        meta = table['meta']
+        capacity = meta['capacity']
+        while capacity < needed_rows:
+            capacity *= 2
+        if capacity == meta['capacity']:
+            return
+        table['matrix'].flush()
+        del table['matrix']
+        with open(table['paths']['matrix'], 'r+b') as f:
+            f.truncate(capacity * meta['dim'] * 4)
+        meta['capacity'] = capacity
+        table['matrix'] = self._map(table['paths'], meta)
+
+    def get_many(self, task: str, canonical_smiles: List[str]) -> Dict[str, np.ndarray]:
+        """批次讀取嵌入向量（回傳記憶體映射的列視圖）"""
+        with self._lock:
+            table = self._open(task)
+            if table is None:
+                return {}
+            index, matrix = table['index'], table['matrix']
+            return {key: matrix[index[key]] for key in canonical_smiles if key in index}
+
+    def put_many(self, task: str, embeddings: Dict[str, np.ndarray]) -> None:
+        """附加新的嵌入向量；先寫矩陣再寫索引，最後寫中繼資料"""
+        if not embeddings:
+            return
+        dim = len(next(iter(embeddings.values())))
+        with self._lock, self._file_lock(task):
+            table = self._open(task, dim)
+            table = self._sync(task, table, dim)
+            index, meta = table['index'], table['meta']
+            new_keys = [key for key in embeddings if key not in index]
+            self._grow(table, meta['rows'] + len(new_keys))
+            matrix = table['matrix']
+            for key, vector in embeddings.items():
+                row = index.get(key)
+                if row is None:
+                    row = meta['rows']
+                    index[key] = row
+                    meta['rows'] += 1
+                matrix[row] = vector
+            matrix.flush()
+            data = ''.join(key + '\n' for key in new_keys).encode('utf-8')
+            with open(table['paths']['index'], 'r+b') as f:
+                # 捨棄中斷寫入留下、未被中繼資料記錄的尾端，讓索引行號與矩陣列一致
+                f.truncate(meta['index_bytes'])
+                f.seek(meta['index_bytes'])
+                f.write(data)
+            meta['index_bytes'] += len(data)
+            self._write_meta(table['paths'], meta)
+
+    def matrix(self, task: str):
+        """回傳 (唯讀矩陣, 標準 SMILES 列表)，供相似度或分群作業直接使用"""
+        with self._lock:
+            table = self._open(task)
+            if table is None:
+                return np.zeros((0, 0), dtype=np.float32), []
+            rows, dim = table['meta']['rows'], table['meta']['dim']
+            keys = sorted(table['index'], key=table['index'].get)
+            if rows == 0:
+                return np.zeros((0, dim), dtype=np.float32), keys
+            return np.memmap(table['paths']['matrix'], dtype=np.float32, mode='r', shape=(rows, dim)), keys
+
+    def _compute(self, service, task_types: List[str],
+                 smiles_list: List[str]) -> Tuple[Dict[str, Dict[str, np.ndarray]], Dict[str, str]]:
+        """透過預測服務計算缺漏的嵌入，回傳 ({端點: {分子: 嵌入}}, {無效分子: 原因})
+
+        分子只特徵化一次再交由各端點模型擷取；以索引作為分子 ID 以便對應。
+        """
+        molecules = [{'molecule_id': str(i), 'smiles': s} for i, s in enumerate(smiles_list)]
+        embeddings, reasons = {}, {}
+        for task, results in service.embed_tasks(molecules, task_types).items():
+            embeddings[task] = {}
+            for r in results:
+                smiles = smiles_list[int(r['molecule_id'])]
+                if r['embedding'] is None:
+                    reasons[smiles] = r.get('error_message') or 'featurization failed'
+                else:
+                    embeddings[task][smiles] = r['embedding']
+        return embeddings, reasons
+
+    def _store_missing(self, per_task: Dict[str, Dict[str, np.ndarray]],
+                       computed: Dict[str, Dict[str, np.ndarray]]) -> Dict[str, int]:
+        """只回寫各端點原本缺漏的嵌入（同批計算的其他分子已在庫中），回傳各端點寫入筆數"""
+        stored = {}
+        for task, vectors in computed.items():
+            missing = {smiles: v for smiles, v in vectors.items() if smiles not in per_task[task]}
+            self.put_many(task, missing)
+            per_task[task].update(missing)
+            stored[task] = len(missing)
+        return stored
+
+    def bulk_embed(self, service, molecules: List[Dict[str, str]], task_types: List[str]) -> List[Dict[str, Any]]:
+        """先讀取嵌入庫，只將未命中的分子交由服務計算並回寫"""
+        canonical = [canonicalize_smiles(mol['smiles']) for mol in molecules]
+        valid_keys = [c for c in dict.fromkeys(canonical) if c is not None]
+
+        per_task: Dict[str, Dict[str, np.ndarray]] = {task: self.get_many(task, valid_keys) for task in task_types}
+        rejected: Dict[str, str] = {}
+        misses = [c for c in valid_keys if any(c not in per_task[task] for task in task_types)]
+        if misses:
+            miss_tasks = [task for task in task_types if any(c not in per_task[task] for c in misses)]
+            computed, rejected = self._compute(service, miss_tasks, misses)
+            self._store_missing(per_task, computed)
+
+        results = []
+        for mol, key in zip(molecules, canonical):
+            reason = rejected.get(key) if key is not None else 'unparseable SMILES'
+            embeddings = {}
+            for task in task_types:
+                vector = per_task[task].get(key) if reason is None else None
+                embeddings[task] = vector.tolist() if vector is not None else None
+            if reason is None and task_types and all(v is None for v in embeddings.values()):
+                reason = 'featurization failed'
+            results.append({
+                'molecule_id': mol['molecule_id'],
+                'smiles': mol['smiles'],
+                'canonical_smiles': key,
+                'embeddings': embeddings,
+                'status': 'error' if reason is not None else 'success',
+                'error_message': reason
+            })
+        return results
+
+    def backfill(self, service, smiles_list: List[str], task_types: List[str], batch_size: int = 1000) -> Dict[str, int]:
+        """預先計算參考分子庫的嵌入，已存在的分子會略過"""
+        keys = [c for c in dict.fromkeys(canonicalize_smiles(s) for s in smiles_list) if c is not None]
+        per_task = {task: self.get_many(task, keys) for task in task_types}
+        misses = [c for c in keys if any(c not in per_task[task] for task in task_types)]
+        miss_tasks = [task for task in task_types if any(c not in per_task[task] for c in misses)]
+        stored = {task: 0 for task in task_types}
+        for start in range(0, len(misses), batch_size):
+            computed, _ = self._compute(service, miss_tasks, misses[start:start + batch_size])
+            for task, n in self._store_missing(per_task, computed).items():
+                stored[task] += n
+            print('embedded {:d}/{:d}'.format(min(start + batch_size, len(misses)), len(misses)))
+        return stored
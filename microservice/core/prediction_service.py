@@ -6,22 +6,26 @@ import pandas as pd
 import tempfile
 import shutil
 from typing import List, Dict, Any
-from torch.utils.data import DataLoader
 
 # 導入原有模組
-from utils import init_featurizer, load_dataset, get_self_configure, mkdir_p, collate_molgraphs, load_model, predict, read_fasta
+from utils import init_featurizer, load_dataset, get_self_configure, mkdir_p, collate_molgraphs, load_model, predict, embed, read_fasta
+from screening import MoleculeScreen
+from microservice.core import profiling
+
+# 預測標籤的字串表示（避免逐列轉換）
+LABELS = {0: '0', 1: '1'}
 
 class ToxicityPredictionService:
     """毒性預測服務核心類別"""
     
-    def __init__(self):
+    def __init__(self, model_root: str = "model"):
         """初始化預測服務"""
         self.supported_tasks = [
             'NR-AR', 'NR-AR-LBD', 'NR-AhR', 'NR-Aromatase',
             'NR-ER', 'NR-ER-LBD', 'NR-PPAR-gamma', 'SR-ARE',
             'SR-ATAD5', 'SR-HSE', 'SR-MMP', 'SR-p53'
         ]
-        self.model_root = "model"
+        self.model_root = model_root
         self.device = torch.device('cpu')
         
         # 預載入模型配置
@@ -30,12 +34,23 @@ class ToxicityPredictionService:
             config_path = os.path.join(self.model_root, task, 'configure.json')
             if os.path.exists(config_path):
                 self.model_configs[task] = get_self_configure(config_path)
+        
+        # 特徵化前的輸入預篩（長度、原子數、鍵數與單分子時間預算）
+        self.screen = MoleculeScreen.from_env()
+        
+        # 推論微批次大小（None 表示整批一次推論，可由 AutoTuner 校準）
+        self.micro_batch_size = None
     
     def _validate_task_type(self, task_type: str) -> None:
         """驗證任務類型"""
         if task_type not in self.supported_tasks:
             raise ValueError(f"不支援的任務類型: {task_type}。支援的類型: {self.supported_tasks}")
     
+    def available_tasks(self) -> List[str]:
+        """具備配置與模型權重檔的任務類型"""
+        return [task for task in self.model_configs
+                if os.path.exists(os.path.join(self.model_root, task, 'model.pth'))]
+    
     def _create_temp_fasta(self, molecules: List[Dict[str, str]]) -> str:
         """創建臨時FASTA檔案"""
         temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.fasta', delete=False)
@@ -50,8 +65,8 @@ class ToxicityPredictionService:
             os.unlink(temp_file.name)
             raise e
     
-    def _prediction(self, args: Dict[str, Any], exp_config: Dict[str, Any], data_set) -> Dict[str, List]:
-        """執行預測邏輯"""
+    def _load_model(self, args: Dict[str, Any], exp_config: Dict[str, Any]):
+        """依任務配置建立模型並載入權重"""
         exp_config.update({
             'model': args['model'],
             'n_tasks': args['n_tasks'],
@@ -59,29 +74,49 @@ class ToxicityPredictionService:
             'bond_featurizer_type': args['bond_featurizer_type']
         })
         
-        test_loader = DataLoader(
-            dataset=data_set, 
-            batch_size=len(data_set), 
-            collate_fn=collate_molgraphs, 
-            num_workers=0
-        )
-        
-        model = load_model(exp_config).to(self.device)
-        model.load_state_dict(
-            torch.load(args['model_data_path']+'/model.pth', map_location=self.device)['model_state_dict']
-        )
-        
-        result = {'id': [], 'smiles': [], 'pre': []}
+        with profiling.stage('load_model'):
+            model = load_model(exp_config).to(self.device)
+            model.load_state_dict(
+                torch.load(args['model_data_path']+'/model.pth', map_location=self.device)['model_state_dict']
+            )
         model.eval()
+        return model
+    
+    def _prediction(self, args: Dict[str, Any], exp_config: Dict[str, Any], data_set) -> Dict[str, List]:
+        """執行預測邏輯"""
+        result = {'id': [], 'smiles': [], 'pre': [], 'proba': []}
+        if len(data_set) == 0:
+            # 整批皆被預篩剔除時不需載入模型
+            return result
+        
+        model = self._load_model(args, exp_config)
         
-        with torch.no_grad():
-            for batch_id, batch_data in enumerate(test_loader):
-                smiles, bg, idx = batch_data
+        with profiling.stage('inference'), torch.no_grad():
+            for smiles, bg, idx in data_set.batches(self.micro_batch_size or len(data_set)):
                 logits = predict(args, model, bg)
                 proba = torch.sigmoid(logits).squeeze(1)
-                result['id'].extend(np.array(idx).squeeze(1))
+                result['id'].extend(i[0] for i in idx)
                 result['smiles'].extend(smiles)
-                result['pre'].extend((proba.detach().cpu().data > exp_config['t1']).int().numpy())
+                # 轉為原生 int/float，格式化時不再逐列處理 numpy 純量
+                result['pre'].extend((proba.detach().cpu().data > exp_config['t1']).int().tolist())
+                result['proba'].extend(proba.detach().cpu().numpy().tolist())
+        
+        return result
+    
+    def _embedding(self, args: Dict[str, Any], exp_config: Dict[str, Any], data_set) -> Dict[str, List]:
+        """計算圖層級讀出向量（MLP 預測器之前的表示）"""
+        result = {'id': [], 'smiles': [], 'embedding': []}
+        if len(data_set) == 0:
+            return result
+        
+        model = self._load_model(args, exp_config)
+        
+        with profiling.stage('embed'), torch.no_grad():
+            for smiles, bg, idx in data_set.batches(self.micro_batch_size or len(data_set)):
+                graph_feats = embed(args, model, bg)
+                result['id'].extend(i[0] for i in idx)
+                result['smiles'].extend(smiles)
+                result['embedding'].extend(graph_feats.detach().cpu().numpy().astype(np.float32))
         
         return result
     
@@ -105,7 +140,8 @@ class ToxicityPredictionService:
                         "smiles": prediction_result["smiles"],
                         "prediction": prediction_result["prediction"],
                         "confidence": prediction_result.get("confidence"),
-                        "status": prediction_result["status"]
+                        "status": prediction_result["status"],
+                        "error_message": prediction_result.get("error_message")
                     }
                 else:
                     return {
@@ -161,10 +197,11 @@ class ToxicityPredictionService:
             if os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
     
-    def _predict_batch_internal(self, molecules: List[Dict[str, str]], task_type: str, output_dir: str) -> List[Dict[str, Any]]:
-        """內部批次預測邏輯"""
+    def _load_molecules(self, molecules: List[Dict[str, str]], task_type: str, output_dir: str):
+        """寫出臨時FASTA並特徵化，回傳 (args, trans_mol, dataset)"""
         # 創建臨時FASTA檔案
-        temp_fasta = self._create_temp_fasta(molecules)
+        with profiling.stage('write_fasta'):
+            temp_fasta = self._create_temp_fasta(molecules)
         
         try:
             # 設定參數
@@ -182,57 +219,155 @@ class ToxicityPredictionService:
             
             args = init_featurizer(args)
             args['device'] = self.device
+            args['screen'] = self.screen
             args['task_names'] = [args['task_names']]
             
             # 讀取數據
-            trans_mol, dataset = read_fasta(args, temp_fasta)
+            with profiling.stage('featurize'):
+                trans_mol, dataset = read_fasta(args, temp_fasta)
+            profiling.annotate(molecule_count=len(trans_mol['id']),
+                               valid_count=len(dataset),
+                               atom_count=dataset.packed.num_nodes)
             args['n_tasks'] = dataset.n_tasks
             args['valid_mol_ids'] = set(dataset.valid_ids)
             args['in_mol_ids'] = set([i for i in range(len(trans_mol['id']))])
             args['invalid_mol_ids'] = list(args['valid_mol_ids'] ^ args['in_mol_ids'])
+            return args, trans_mol, dataset
             
-            # 獲取模型配置
-            exp_config = get_self_configure(args['model_data_path'] + '/configure.json')
-            
-            # 執行預測
-            result = self._prediction(args, exp_config, dataset)
-            
-            # 處理無效分子
-            if args['invalid_mol_ids']:
-                try:
-                    result['id'].extend(np.array(trans_mol['id'])[args['invalid_mol_ids']])
-                    result['smiles'].extend(np.array(trans_mol['SMILES'])[args['invalid_mol_ids']])
-                    result['pre'].extend(['invalid mol']*len(args['invalid_mol_ids']))
-                except (IndexError, TypeError) as e:
-                    # 如果索引出錯，添加默認的無效分子結果
-                    for invalid_id in args['invalid_mol_ids']:
-                        if invalid_id < len(trans_mol['id']):
-                            result['id'].append(trans_mol['id'][invalid_id])
-                            result['smiles'].append(trans_mol['SMILES'][invalid_id])
-                            result['pre'].append('invalid mol')
-            
-            # 格式化結果
+        finally:
+            # 清理臨時FASTA檔案
+            if os.path.exists(temp_fasta):
+                os.unlink(temp_fasta)
+    
+    def _predict_batch_internal(self, molecules: List[Dict[str, str]], task_type: str, output_dir: str) -> List[Dict[str, Any]]:
+        """內部批次預測邏輯"""
+        args, trans_mol, dataset = self._load_molecules(molecules, task_type, output_dir)
+        
+        # 獲取模型配置
+        exp_config = get_self_configure(args['model_data_path'] + '/configure.json')
+        
+        # 執行預測
+        result = self._prediction(args, exp_config, dataset)
+        return self._format_results(result, args, trans_mol, dataset)
+    
+    def _format_results(self, result: Dict[str, List], args: Dict[str, Any], trans_mol, dataset) -> List[Dict[str, Any]]:
+        """附加無效分子並格式化預測結果"""
+        result['reason'] = [None] * len(result['id'])
+        
+        # 處理無效分子
+        if args['invalid_mol_ids']:
+            try:
+                result['id'].extend([trans_mol['id'][i] for i in args['invalid_mol_ids']])
+                result['smiles'].extend([trans_mol['SMILES'][i] for i in args['invalid_mol_ids']])
+                result['pre'].extend(['invalid mol']*len(args['invalid_mol_ids']))
+                result['proba'].extend([None]*len(args['invalid_mol_ids']))
+                result['reason'].extend([dataset.rejections.get(i) for i in args['invalid_mol_ids']])
+            except (IndexError, TypeError) as e:
+                # 如果索引出錯，添加默認的無效分子結果
+                for invalid_id in args['invalid_mol_ids']:
+                    if invalid_id < len(trans_mol['id']):
+                        result['id'].append(trans_mol['id'][invalid_id])
+                        result['smiles'].append(trans_mol['SMILES'][invalid_id])
+                        result['pre'].append('invalid mol')
+                        result['proba'].append(None)
+                        result['reason'].append(dataset.rejections.get(invalid_id))
+        
+        # 格式化結果
+        with profiling.stage('format'):
             formatted_results = []
             for i in range(len(result['id'])):
                 prediction_value = result['pre'][i]
+                probability = result['proba'][i]
                 if prediction_value == 'invalid mol':
                     status = "error"
                     confidence = None
                 else:
                     status = "success"
-                    confidence = float(prediction_value) if isinstance(prediction_value, (int, float)) else None
+                    # 預測標籤的機率：陽性取模型輸出機率，陰性取其補數
+                    confidence = probability if prediction_value == 1 else 1.0 - probability
                 
-                formatted_results.append({
+                formatted = {
                     "molecule_id": result['id'][i],
                     "smiles": result['smiles'][i],
-                    "prediction": str(prediction_value),
+                    "prediction": LABELS.get(prediction_value, prediction_value),
                     "confidence": confidence,
+                    "probability": probability,
                     "status": status
-                })
-            
-            return formatted_results
-            
+                }
+                if status == "error":
+                    formatted["error_message"] = result['reason'][i] or "featurization failed"
+                formatted_results.append(formatted)
+        
+        return formatted_results
+    
+    def predict_tasks(self, molecules: List[Dict[str, str]], task_types: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """多端點批次預測：分子只特徵化一次，再依序以各端點的模型推論"""
+        for task_type in task_types:
+            self._validate_task_type(task_type)
+        
+        if not molecules:
+            raise ValueError("分子列表不能為空")
+        if not task_types:
+            return {}
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            # 各端點共用相同的原子特徵化器，特徵化結果與端點無關
+            args, trans_mol, dataset = self._load_molecules(molecules, task_types[0], temp_dir)
+            results = {}
+            for task_type in task_types:
+                task_args = dict(args, model_data_path=os.path.join(self.model_root, task_type))
+                exp_config = get_self_configure(task_args['model_data_path'] + '/configure.json')
+                result = self._prediction(task_args, exp_config, dataset)
+                results[task_type] = self._format_results(result, task_args, trans_mol, dataset)
+            return results
         finally:
-            # 清理臨時FASTA檔案
-            if os.path.exists(temp_fasta):
-                os.unlink(temp_fasta) 
\ No newline at end of file
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+    
+    def embed_batch(self, molecules: List[Dict[str, str]], task_type: str) -> List[Dict[str, Any]]:
+        """批次計算分子的圖嵌入向量，無效分子的 embedding 為 None"""
+        return self.embed_tasks(molecules, [task_type])[task_type]
+    
+    def embed_tasks(self, molecules: List[Dict[str, str]], task_types: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """多端點圖嵌入：分子只特徵化一次，再依序以各端點的模型擷取讀出向量"""
+        for task_type in task_types:
+            self._validate_task_type(task_type)
+        
+        if not molecules:
+            raise ValueError("分子列表不能為空")
+        if not task_types:
+            return {}
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            args, trans_mol, dataset = self._load_molecules(molecules, task_types[0], temp_dir)
+            results = {}
+            for task_type in task_types:
+                task_args = dict(args, model_data_path=os.path.join(self.model_root, task_type))
+                exp_config = get_self_configure(task_args['model_data_path'] + '/configure.json')
+                result = self._embedding(task_args, exp_config, dataset)
+                results[task_type] = self._format_embeddings(result, task_args, trans_mol, dataset)
+            return results
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+    
+    def _format_embeddings(self, result: Dict[str, List], args: Dict[str, Any], trans_mol: Dict[str, List],
+                           dataset) -> List[Dict[str, Any]]:
+        """有效分子附上嵌入向量，無效分子附上拒絕原因"""
+        formatted_results = [{
+            "molecule_id": result['id'][i],
+            "smiles": result['smiles'][i],
+            "embedding": result['embedding'][i],
+            "status": "success"
+        } for i in range(len(result['id']))]
+        for invalid_id in args['invalid_mol_ids']:
+            formatted_results.append({
+                "molecule_id": trans_mol['id'][invalid_id],
+                "smiles": trans_mol['SMILES'][invalid_id],
+                "embedding": None,
+                "status": "error",
+                "error_message": dataset.rejections.get(invalid_id) or "featurization failed"
+            })
+        return formatted_results
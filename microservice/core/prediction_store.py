@@ -0,0 +1,266 @@
+#coding=utf-8
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+from rdkit import Chem
+from rdkit import RDLogger
+
+# 關閉 RDKit 對無效 SMILES 的大量警告輸出
+RDLogger.DisableLog('rdApp.*')
+
+
+def canonicalize_smiles(smiles: str) -> Optional[str]:
+    """轉為 RDKit 標準 SMILES，無法解析時回傳 None"""
+    mol = Chem.MolFromSmiles(smiles) if smiles else None
+    if mol is None:
+        return None
+    return Chem.MolToSmiles(mol)
+
+
+# task 路徑 -> (修改時間, 檔案大小, 校驗碼)
+_checksums: Dict[str, Tuple[float, int, str]] = {}
+_checksum_lock = threading.Lock()
+
+
+def model_checksum(model_root: str, task: str) -> str:
+    """計算 model/<task>/model.pth 的 SHA-256，依修改時間與大小快取"""
+    model_path = os.path.join(model_root, task, 'model.pth')
+    stat = os.stat(model_path)
+    cached = _checksums.get(model_path)
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    checksum = digest.hexdigest()
+    with _checksum_lock:
+        _checksums[model_path] = (stat.st_mtime, stat.st_size, checksum)
+    return checksum
+
+
+class PredictionStore:
+    """持久化預測結果庫：以標準 SMILES 與端點為鍵，保存機率與模型校驗碼"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS predictions (
+            canonical_smiles TEXT NOT NULL,
+            task TEXT NOT NULL,
+            model_checksum TEXT NOT NULL,
+            probability REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (canonical_smiles, task)
+        )
+    """
+    # 特徵化前預篩或特徵化失敗的分子（與端點無關），避免每次查詢都重新特徵化
+    REJECTIONS_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rejections (
+            canonical_smiles TEXT PRIMARY KEY,
+            screen TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """
+    # SQLite 單一查詢的參數上限保守值
+    CHUNK_SIZE = 500
+
+    def __init__(self, db_path: str, model_root: str = "model"):
+        self.db_path = db_path
+        self.model_root = model_root
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(self.SCHEMA)
+            conn.execute(self.REJECTIONS_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def model_checksum(self, task: str) -> str:
+        return model_checksum(self.model_root, task)
+
+    def get_many(self, canonical_smiles: Iterable[str], task: str, checksum: str) -> Dict[str, float]:
+        """批次查詢，只回傳與目前模型校驗碼相符的結果"""
+        keys = list(dict.fromkeys(canonical_smiles))
+        found = {}
+        with self._connect() as conn:
+            for start in range(0, len(keys), self.CHUNK_SIZE):
+                chunk = keys[start:start + self.CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT canonical_smiles, probability FROM predictions "
+                    f"WHERE task = ? AND model_checksum = ? AND canonical_smiles IN ({placeholders})",
+                    [task, checksum] + chunk
+                )
+                found.update(rows)
+        return found
+
+    def put_many(self, task: str, checksum: str, probabilities: Dict[str, float]) -> None:
+        """寫入或覆寫某端點的預測機率"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO predictions "
+                "(canonical_smiles, task, model_checksum, probability, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(smiles, task, checksum, float(p), now) for smiles, p in probabilities.items()]
+            )
+
+    def get_rejections(self, canonical_smiles: Iterable[str], screen: str) -> Dict[str, str]:
+        """批次查詢已知無法特徵化的分子，只回傳與目前預篩設定相符的記錄"""
+        keys = list(dict.fromkeys(canonical_smiles))
+        found = {}
+        with self._connect() as conn:
+            for start in range(0, len(keys), self.CHUNK_SIZE):
+                chunk = keys[start:start + self.CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT canonical_smiles, reason FROM rejections "
+                    f"WHERE screen = ? AND canonical_smiles IN ({placeholders})",
+                    [screen] + chunk
+                )
+                found.update(rows)
+        return found
+
+    def put_rejections(self, screen: str, reasons: Dict[str, str]) -> None:
+        """記錄無法特徵化的分子與原因"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rejections (canonical_smiles, screen, reason, updated_at) VALUES (?, ?, ?, ?)",
+                [(smiles, screen, reason, now) for smiles, reason in reasons.items()]
+            )
+
+    def stale_smiles(self, task: str, checksum: str) -> List[str]:
+        """找出該端點需要重新評分的分子：校驗碼過期，或其他端點已有但本端點缺少"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT canonical_smiles FROM predictions "
+                "WHERE canonical_smiles NOT IN ("
+                "    SELECT canonical_smiles FROM predictions WHERE task = ? AND model_checksum = ?"
+                ")",
+                (task, checksum)
+            )
+            return [row[0] for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        """各端點的筆數統計"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT task, model_checksum, COUNT(*) FROM predictions GROUP BY task, model_checksum")
+            return {
+                'db_path': self.db_path,
+                'entries': [{'task': t, 'model_checksum': c, 'count': n} for t, c, n in rows]
+            }
+
+    def _score(self, service, task_types: List[str],
+               smiles_list: List[str]) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str]]:
+        """透過預測服務計算缺漏的機率，回傳 ({端點: {分子: 機率}}, {無效分子: 原因})
+
+        分子只特徵化一次再交由各端點模型推論；以索引作為分子 ID 以便對應。
+        """
+        molecules = [{'molecule_id': str(i), 'smiles': s} for i, s in enumerate(smiles_list)]
+        probabilities, reasons = {}, {}
+        for task, results in service.predict_tasks(molecules, task_types).items():
+            probabilities[task] = {}
+            for r in results:
+                smiles = smiles_list[int(r['molecule_id'])]
+                if r.get('probability') is None:
+                    reasons[smiles] = r.get('error_message') or 'featurization failed'
+                else:
+                    probabilities[task][smiles] = r['probability']
+        return probabilities, reasons
+
+    def _store_scores(self, service, checksums: Dict[str, str], probabilities: Dict[str, Dict[str, float]],
+                      reasons: Dict[str, str]) -> None:
+        for task, computed in probabilities.items():
+            self.put_many(task, checksums[task], computed)
+        self.put_rejections(service.screen.signature(),
+                            {s: r for s, r in reasons.items() if not service.screen.is_transient(r)})
+
+    def bulk_lookup(self, service, molecules: List[Dict[str, str]], task_types: List[str]) -> List[Dict[str, Any]]:
+        """先查詢結果庫，只將未命中的分子交由預測服務計算並回寫"""
+        canonical = [canonicalize_smiles(mol['smiles']) for mol in molecules]
+        valid_keys = [c for c in dict.fromkeys(canonical) if c is not None]
+
+        rejected = self.get_rejections(valid_keys, service.screen.signature())
+        candidates = [c for c in valid_keys if c not in rejected]
+        checksums = {task: self.model_checksum(task) for task in task_types}
+        per_task: Dict[str, Dict[str, float]] = {
+            task: self.get_many(candidates, task, checksums[task]) for task in task_types
+        }
+        misses = [c for c in candidates if any(c not in per_task[task] for task in task_types)]
+        if misses:
+            miss_tasks = [task for task in task_types if any(c not in per_task[task] for c in misses)]
+            computed, reasons = self._score(service, miss_tasks, misses)
+            self._store_scores(service, checksums, computed, reasons)
+            for task, probabilities in computed.items():
+                per_task[task].update(probabilities)
+            rejected.update(reasons)
+
+        results = []
+        for mol, key in zip(molecules, canonical):
+            reason = rejected.get(key) if key is not None else 'unparseable SMILES'
+            predictions = {}
+            for task in task_types:
+                probability = per_task[task].get(key) if reason is None else None
+                if probability is None:
+                    predictions[task] = {'probability': None, 'prediction': 'invalid mol'}
+                else:
+                    threshold = service.model_configs[task]['t1']
+                    predictions[task] = {'probability': probability,
+                                         'prediction': str(int(probability > threshold))}
+            if reason is None and task_types and all(p['probability'] is None for p in predictions.values()):
+                reason = 'featurization failed'
+            results.append({
+                'molecule_id': mol['molecule_id'],
+                'smiles': mol['smiles'],
+                'canonical_smiles': key,
+                'predictions': predictions,
+                'status': 'error' if reason is not None else 'success',
+                'error_message': reason
+            })
+        return results
+
+    def backfill(self, service, smiles_list: List[str], task_types: List[str], batch_size: int = 1000) -> Dict[str, int]:
+        """將參考分子庫預先評分寫入結果庫，已是最新或已知無效的分子會略過"""
+        keys = [c for c in dict.fromkeys(canonicalize_smiles(s) for s in smiles_list) if c is not None]
+        rejected = self.get_rejections(keys, service.screen.signature())
+        keys = [c for c in keys if c not in rejected]
+        checksums = {task: self.model_checksum(task) for task in task_types}
+        found = {task: self.get_many(keys, task, checksums[task]) for task in task_types}
+        misses = [c for c in keys if any(c not in found[task] for task in task_types)]
+        miss_tasks = [task for task in task_types if any(c not in found[task] for c in misses)]
+        scored = {task: 0 for task in task_types}
+        scored.update(self._score_in_batches(service, miss_tasks, checksums, misses, batch_size))
+        return scored
+
+    def rescore_stale(self, service, task_types: List[str], batch_size: int = 1000) -> Dict[str, int]:
+        """模型檔更新後，只重新評分校驗碼已過期的端點"""
+        scored = {}
+        for task in task_types:
+            checksum = self.model_checksum(task)
+            scored.update(self._score_in_batches(service, [task], {task: checksum},
+                                                 self.stale_smiles(task, checksum), batch_size))
+        return scored
+
+    def _score_in_batches(self, service, task_types: List[str], checksums: Dict[str, str],
+                          smiles_list: List[str], batch_size: int) -> Dict[str, int]:
+        counts = {task: 0 for task in task_types}
+        for start in range(0, len(smiles_list), batch_size):
+            computed, reasons = self._score(service, task_types, smiles_list[start:start + batch_size])
+            self._store_scores(service, checksums, computed, reasons)
+            for task, probabilities in computed.items():
+                counts[task] += len(probabilities)
+            print('[{}] scored {:d}/{:d}'.format(','.join(task_types), min(start + batch_size, len(smiles_list)), len(smiles_list)))
+        return counts
@@ -0,0 +1,211 @@
+#coding=utf-8
+import os
+import io
+import json
+import time
+import uuid
+import random
+import pstats
+import shutil
+import cProfile
+import threading
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import List, Dict, Any, Optional
+
+import torch
+
+# 目前請求的剖析會話（未剖析時為 None）
+_current_session: ContextVar = ContextVar('ssl_gcn_profile_session', default=None)
+
+
+class ProfileSession:
+    """單一請求的剖析會話，記錄階段耗時與分子統計"""
+
+    def __init__(self, trace_id: str, trace_dir: str, meta: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.trace_dir = trace_dir
+        self.meta = dict(meta)
+        self.meta.update({'trace_id': trace_id, 'molecule_count': 0, 'atom_count': 0})
+        self.stages: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """記錄一個階段的耗時，並在 torch 追蹤中標示"""
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            try:
+                yield
+            finally:
+                self.stages.append({'stage': name, 'seconds': time.perf_counter() - start})
+
+    def annotate(self, **kwargs) -> None:
+        """累加數值型統計（分子數、原子數），其他欄位直接覆寫"""
+        for key, value in kwargs.items():
+            if isinstance(value, (int, float)) and isinstance(self.meta.get(key), (int, float)):
+                self.meta[key] += value
+            else:
+                self.meta[key] = value
+
+
+def stage(name: str):
+    """目前請求正在剖析時記錄階段，否則不做任何事"""
+    session = _current_session.get()
+    return session.stage(name) if session is not None else nullcontext()
+
+
+def annotate(**kwargs) -> None:
+    """目前請求正在剖析時附加統計資訊"""
+    session = _current_session.get()
+    if session is not None:
+        session.annotate(**kwargs)
+
+
+class RequestProfiler:
+    """按需請求剖析器：以 cProfile 與 torch.profiler 包裹單一請求並寫出追蹤檔"""
+
+    ARTIFACTS = {
+        'meta': 'meta.json',
+        'cprofile': 'cprofile.prof',
+        'cprofile_text': 'cprofile.txt',
+        'torch': 'torch_trace.json',
+    }
+
+    def __init__(self, trace_root: Optional[str] = None, enabled: Optional[bool] = None,
+                 sample_rate: Optional[float] = None, max_traces: Optional[int] = None):
+        self.trace_root = trace_root or os.environ.get('SSL_GCN_PROFILE_DIR', 'profiles')
+        if enabled is None:
+            enabled = os.environ.get('SSL_GCN_PROFILE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.sample_rate = float(sample_rate if sample_rate is not None
+                                 else os.environ.get('SSL_GCN_PROFILE_SAMPLE_RATE', '0'))
+        self.max_traces = int(max_traces if max_traces is not None
+                              else os.environ.get('SSL_GCN_PROFILE_MAX_TRACES', '50'))
+        # cProfile 同一時間只能有一個啟用中的剖析器
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None) -> Dict[str, Any]:
+        """更新剖析設定（管理端點使用）"""
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            if not 0.0 <= sample_rate <= 1.0:
+                raise ValueError(f"取樣率必須介於 0 與 1 之間: {sample_rate}")
+            self.sample_rate = sample_rate
+        return self.settings()
+
+    def settings(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'max_traces': self.max_traces,
+            'trace_root': self.trace_root,
+        }
+
+    def should_profile(self, requested: bool = False) -> bool:
+        """剖析啟用時，請求標頭強制剖析，否則依取樣率抽樣"""
+        if not self.enabled:
+            return False
+        return requested or random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, active: bool, **meta):
+        """active 為真時剖析包裹的程式碼（已有剖析進行中則略過），產出 ProfileSession 或 None"""
+        if not active or not self._lock.acquire(blocking=False):
+            yield None
+            return
+        try:
+            with self._profile(meta) as session:
+                yield session
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def _profile(self, meta: Dict[str, Any]):
+        trace_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        trace_dir = os.path.join(self.trace_root, trace_id)
+        os.makedirs(trace_dir, exist_ok=True)
+
+        session = ProfileSession(trace_id, trace_dir, meta)
+        session.meta['started_at'] = time.time()
+        token = _current_session.set(session)
+        profiler = cProfile.Profile()
+        torch_prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                            record_shapes=True)
+        start = time.perf_counter()
+        try:
+            with torch_prof:
+                profiler.enable()
+                try:
+                    yield session
+                finally:
+                    profiler.disable()
+        except Exception as e:
+            session.meta['error'] = str(e)
+            raise
+        finally:
+            _current_session.reset(token)
+            session.meta['total_seconds'] = time.perf_counter() - start
+            session.meta['stages'] = session.stages
+            self._write_trace(session, profiler, torch_prof)
+            self._prune()
+
+    def _write_trace(self, session: ProfileSession, profiler: cProfile.Profile, torch_prof) -> None:
+        profiler.dump_stats(os.path.join(session.trace_dir, self.ARTIFACTS['cprofile']))
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(50)
+        with open(os.path.join(session.trace_dir, self.ARTIFACTS['cprofile_text']), 'w') as f:
+            f.write(stream.getvalue())
+        torch_prof.export_chrome_trace(os.path.join(session.trace_dir, self.ARTIFACTS['torch']))
+        with open(os.path.join(session.trace_dir, self.ARTIFACTS['meta']), 'w') as f:
+            json.dump(session.meta, f, ensure_ascii=False, indent=2, default=str)
+
+    def record_stage(self, trace_id: str, name: str, seconds: float) -> None:
+        """補記剖析範圍之外的階段（例如合併所有切片後的回應編碼）到追蹤中繼資料"""
+        try:
+            path = self.artifact_path(trace_id, 'meta')
+            with open(path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            # 追蹤已被清除
+            return
+        meta.setdefault('stages', []).append({'stage': name, 'seconds': seconds})
+        with open(path, 'w') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2, default=str)
+
+    def _trace_ids(self) -> List[str]:
+        if not os.path.isdir(self.trace_root):
+            return []
+        return sorted((d for d in os.listdir(self.trace_root)
+                       if os.path.isdir(os.path.join(self.trace_root, d))), reverse=True)
+
+    def _prune(self) -> None:
+        """只保留最近 max_traces 筆追蹤"""
+        for trace_id in self._trace_ids()[self.max_traces:]:
+            shutil.rmtree(os.path.join(self.trace_root, trace_id), ignore_errors=True)
+
+    def list_traces(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """列出最近的追蹤摘要"""
+        traces = []
+        for trace_id in self._trace_ids()[:limit]:
+            try:
+                traces.append(self.get_trace(trace_id))
+            except (OSError, ValueError):
+                continue
+        return traces
+
+    def get_trace(self, trace_id: str) -> Dict[str, Any]:
+        """讀取追蹤的中繼資料"""
+        with open(self.artifact_path(trace_id, 'meta'), 'r') as f:
+            return json.load(f)
+
+    def artifact_path(self, trace_id: str, artifact: str) -> str:
+        """取得追蹤檔案路徑，拒絕路徑穿越"""
+        if artifact not in self.ARTIFACTS:
+            raise ValueError(f"未知的追蹤檔案類型: {artifact}。支援的類型: {list(self.ARTIFACTS)}")
+        if os.path.basename(trace_id) != trace_id or trace_id in ('', '.', '..'):
+            raise ValueError(f"無效的追蹤 ID: {trace_id}")
+        path = os.path.join(self.trace_root, trace_id, self.ARTIFACTS[artifact])
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"找不到追蹤檔案: {trace_id}/{artifact}")
+        return path
@@ -0,0 +1,257 @@
+#coding=utf-8
+import os
+import re
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# SMILES 中的原子記號（含方括號原子），用來在特徵化前粗估原子數
+ATOM_TOKEN = re.compile(r'\[[^\]]*\]|Cl|Br|[BCNOPSFI]|[bcnops]')
+
+
+class _Job:
+    __slots__ = ('client', 'lane', 'cost', 'fn', 'ctx', 'future', 'enqueued_at', 'aborted')
+
+    def __init__(self, client: str, lane: str, cost: float, fn: Callable[[], Any], future: asyncio.Future,
+                 aborted: Optional[asyncio.Event] = None):
+        self.client = client
+        self.lane = lane
+        self.cost = cost
+        self.fn = fn
+        # 保留提交時的 context（剖析會話等 ContextVar）
+        self.ctx = contextvars.copy_context()
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+        # 同一請求的切片共用：任一切片失敗時設定，派送器略過其餘切片
+        self.aborted = aborted
+
+
+class _Lane:
+    """單一優先通道：依客戶累積服務成本挑選下一個工作（成本加權公平佇列）"""
+
+    def __init__(self):
+        self.queues: 'OrderedDict[str, deque]' = OrderedDict()
+        self.served: Dict[str, float] = {}
+        self.waits: deque = deque(maxlen=1000)
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __bool__(self):
+        return bool(self.queues)
+
+    def push(self, job: _Job) -> None:
+        if job.client not in self.queues:
+            self.queues[job.client] = deque()
+            # 新加入的客戶從目前最小的累積成本起算，不因閒置而取得無限優先權
+            self.served[job.client] = min(self.served.values(), default=0.0)
+        self.queues[job.client].append(job)
+
+    def pop(self) -> _Job:
+        client = min(self.queues, key=lambda c: self.served[c])
+        queue = self.queues[client]
+        job = queue.popleft()
+        self.served[client] += job.cost
+        if not queue:
+            del self.queues[client]
+            del self.served[client]
+        return job
+
+    def record_wait(self, wait: float) -> None:
+        self.waits.append(wait)
+        self.completed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self.waits)
+
+        def percentile(p: float) -> Optional[float]:
+            if not waits:
+                return None
+            return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000
+
+        return {
+            'queued_jobs': sum(len(q) for q in self.queues.values()),
+            'queued_cost': sum(job.cost for q in self.queues.values() for job in q),
+            'queued_clients': len(self.queues),
+            'completed_jobs': self.completed,
+            'queue_wait_ms': {
+                'mean': self.total_wait / self.completed * 1000 if self.completed else None,
+                'p50': percentile(0.50),
+                'p95': percentile(0.95),
+                'max': self.max_wait * 1000,
+            },
+        }
+
+
+def estimate_cost(molecules: List[Dict[str, str]]) -> float:
+    """以分子數與粗估原子數估計請求成本（每個分子固定成本 1 加上原子數）"""
+    return float(sum(1 + len(ATOM_TOKEN.findall(mol.get('smiles', ''))) for mol in molecules))
+
+
+class AdmissionScheduler:
+    """成本感知的准入排程器
+
+    請求依估計成本分入互動（interactive）與批量（bulk）兩個通道；通道內依客戶
+    累積成本公平分享，大批次切成多個切片排隊，讓小請求能插在切片之間執行。
+    兩個通道都有工作時，每執行 interactive_weight 個互動工作才執行一個批量工作。
+    工作在單一專用工作執行緒上逐一執行（模型平行度由 torch 的 intra-op 執行緒提供），
+    事件迴圈因此能在切片執行期間持續接收請求、回應健康檢查並記錄入列時間。
+    """
+
+    def __init__(self, slice_cost: Optional[float] = None, bulk_threshold: Optional[float] = None,
+                 interactive_weight: Optional[int] = None):
+        self.slice_cost = float(slice_cost if slice_cost is not None
+                                else os.environ.get('SSL_GCN_SLICE_COST', '5000'))
+        self.bulk_threshold = float(bulk_threshold if bulk_threshold is not None
+                                    else os.environ.get('SSL_GCN_BULK_COST_THRESHOLD', '1000'))
+        self.interactive_weight = int(interactive_weight if interactive_weight is not None
+                                      else os.environ.get('SSL_GCN_INTERACTIVE_WEIGHT', '4'))
+        self.lanes = {INTERACTIVE: _Lane(), BULK: _Lane()}
+        self._interactive_streak = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _worker(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ssl-gcn-worker')
+        return self._executor
+
+    def start(self) -> None:
+        """在事件迴圈中啟動派送工作"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._dispatch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def call(self, fn: Callable[[], Any]) -> Any:
+        """在工作執行緒上執行 fn（不經通道排隊），供校準與調整 torch 設定等需與推論同執行緒的操作"""
+        ctx = contextvars.copy_context()
+        return await asyncio.get_event_loop().run_in_executor(self._worker(), ctx.run, fn)
+
+    def classify(self, cost: float, interactive: bool = False) -> str:
+        return INTERACTIVE if interactive or cost <= self.bulk_threshold else BULK
+
+    def split(self, molecules: List[Dict[str, str]], weight: float = 1.0,
+              min_slice: int = 1) -> List[List[Dict[str, str]]]:
+        """依累積成本將分子列表切成不超過 slice_cost 的切片
+
+        每片至少 min_slice 個分子（例如推論的微批次大小），切片不會小於一個微批次。
+        """
+        slices, current, current_cost = [], [], 0.0
+        for mol in molecules:
+            cost = estimate_cost([mol]) * weight
+            if len(current) >= max(min_slice, 1) and current_cost + cost > self.slice_cost:
+                slices.append(current)
+                current, current_cost = [], 0.0
+            current.append(mol)
+            current_cost += cost
+        if current:
+            slices.append(current)
+        return slices
+
+    async def submit(self, client: str, lane: str, cost: float, fn: Callable[[], Any],
+                     aborted: Optional[asyncio.Event] = None) -> Tuple[Any, float]:
+        """排入一個工作並等待結果，回傳 (結果, 佇列等待秒數)"""
+        if self._task is None:
+            self.start()
+        job = _Job(client, lane, cost, fn, asyncio.get_event_loop().create_future(), aborted)
+        self.lanes[lane].push(job)
+        self._wakeup.set()
+        return await job.future
+
+    async def run(self, client: str, molecules: List[Dict[str, str]],
+                  fn: Callable[[List[Dict[str, str]]], List[Any]],
+                  interactive: bool = False, weight: float = 1.0,
+                  min_slice: int = 1) -> Tuple[List[Any], float, str]:
+        """切片執行 fn 並依原始順序合併，回傳 (結果, 最長佇列等待秒數, 通道)
+
+        weight 為每個分子的工作量倍數（例如一次查詢多個端點），計入通道分類、切片與公平分享。
+        任一切片失敗或請求被取消時，尚未執行的切片一併取消。
+        佇列等待為切片入列（請求本文已解析）到開始在工作執行緒上執行的時間。
+        """
+        lane = self.classify(estimate_cost(molecules) * weight, interactive)
+        slices = self.split(molecules, weight, min_slice)
+        aborted = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.submit(client, lane, estimate_cost(part) * weight,
+                                                   lambda part=part: fn(part), aborted))
+                 for part in slices]
+        try:
+            outcomes = await asyncio.gather(*tasks)
+        except BaseException:
+            # 取消等待中的切片（派送時會略過已取消的工作）
+            aborted.set()
+            for task in tasks:
+                task.cancel()
+            raise
+        results = [row for part_results, _ in outcomes for row in part_results]
+        return results, max(wait for _, wait in outcomes), lane
+
+    def _next_job(self) -> Optional[_Job]:
+        interactive, bulk = self.lanes[INTERACTIVE], self.lanes[BULK]
+        if interactive and (not bulk or self._interactive_streak < self.interactive_weight):
+            self._interactive_streak += 1
+            return interactive.pop()
+        if bulk:
+            self._interactive_streak = 0
+            return bulk.pop()
+        return None
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if job.future.cancelled() or (job.aborted is not None and job.aborted.is_set()):
+                # 用戶端已斷線或同一請求的其他切片已失敗，略過
+                if not job.future.done():
+                    job.future.cancel()
+                continue
+            wait = time.perf_counter() - job.enqueued_at
+            self.lanes[job.lane].record_wait(wait)
+            try:
+                result = await loop.run_in_executor(self._worker(), job.ctx.run, job.fn)
+            except asyncio.CancelledError:
+                # 排程器停止：通知等待中的請求
+                job.future.cancel()
+                raise
+            except Exception as e:
+                # 派送器在請求收到例外前就可能取出下一個切片，先標記整個請求失敗
+                if job.aborted is not None:
+                    job.aborted.set()
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                # 執行期間請求可能已被取消
+                if not job.future.done():
+                    job.future.set_result((result, wait))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'slice_cost': self.slice_cost,
+            'bulk_threshold': self.bulk_threshold,
+            'interactive_weight': self.interactive_weight,
+            'lanes': {name: lane.stats() for name, lane in self.lanes.items()},
+        }
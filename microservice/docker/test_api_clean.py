@@ -5,16 +5,21 @@ SSL-GCN API 測試腳本
 測試所有API端點的功能和錯誤處理
 """
 
+import os
 import requests
 import json
 import time
+import random
+import threading
 from typing import Dict, List, Any
 
 class SSLGCNAPITester:
-    def __init__(self, base_url: str = "http://localhost:8007"):
+    def __init__(self, base_url: str = "http://localhost:8007", admin_token: str = None):
         self.base_url = base_url
         self.session = requests.Session()
         self.session.headers.update({"Content-Type": "application/json"})
+        # 管理端點：未設定權杖時僅接受本機請求
+        self.admin_headers = {"X-Admin-Token": admin_token} if admin_token else {}
         
     def print_test_header(self, test_name: str):
         """打印測試標題"""
@@ -146,6 +151,192 @@ class SSLGCNAPITester:
             self.print_result(False, error=str(e))
             return None
     
+    def _store_count(self, task_types: List[str]) -> int:
+        """結果庫中指定端點的總筆數"""
+        response = self.session.get(f"{self.base_url}/admin/store", headers=self.admin_headers)
+        response.raise_for_status()
+        return sum(e['count'] for e in response.json()['entries'] if e['task'] in task_types)
+
+    def test_lookup(self, task_types: List[str]):
+        """測試結果庫查詢：首次未命中會計算並寫入，再次查詢直接命中，無效分子回傳錯誤列"""
+        self.print_test_header(f"結果庫查詢 - {len(task_types)} 個端點")
+        try:
+            # 帶隨機同位素標記的分子，確保本次執行前不在結果庫中
+            fresh = f"[{random.randint(100, 999)}CH3]" + "C" * random.randint(1, 20) + "O"
+            molecules = [
+                {"molecule_id": "FRESH", "smiles": fresh},
+                {"molecule_id": "UNPARSEABLE", "smiles": "C1CC"}
+            ]
+            data = {"molecules": molecules, "task_types": task_types}
+
+            before = self._store_count(task_types)
+            response = self.session.post(f"{self.base_url}/predict/lookup", json=data)
+            response.raise_for_status()
+            first = response.json()
+            after_miss = self._store_count(task_types)
+            if after_miss - before != len(task_types):
+                self.print_result(False, error=f"未命中應寫入 {len(task_types)} 筆，實際 {after_miss - before} 筆")
+                return False
+
+            response = self.session.post(f"{self.base_url}/predict/lookup", json=data)
+            response.raise_for_status()
+            second = response.json()
+            if self._store_count(task_types) != after_miss:
+                self.print_result(False, error="命中時不應再寫入結果庫")
+                return False
+            if first[0]['status'] != 'success' or first[0]['predictions'] != second[0]['predictions']:
+                self.print_result(False, error="命中的結果與首次計算不同")
+                return False
+
+            rejection = second[1]
+            if rejection['status'] != 'error' or not rejection['error_message']:
+                self.print_result(False, error="無效分子未回傳錯誤狀態與原因")
+                return False
+            if any(p['probability'] is not None for p in rejection['predictions'].values()):
+                self.print_result(False, error="無效分子不應有機率")
+                return False
+            self.print_result(True, second)
+            return True
+        except Exception as e:
+            self.print_result(False, error=str(e))
+            return False
+
+    def test_screen_rejections(self, task_type: str):
+        """測試分子前置篩檢：被拒絕的分子回傳錯誤狀態與原因，不影響同批次的有效分子"""
+        self.print_test_header("分子前置篩檢")
+        cases = [
+            ("TOO_LONG", "C" * 5000, "longer than"),
+            ("BAD_CHARS", "CCO; DROP TABLE", "invalid characters"),
+            ("UNPARSEABLE", "C1CC", "unparseable"),
+        ]
+        try:
+            molecules = [{"molecule_id": "ETHANOL", "smiles": "CCO"}]
+            molecules += [{"molecule_id": mol_id, "smiles": smiles} for mol_id, smiles, _ in cases]
+            response = self.session.post(f"{self.base_url}/predict/batch",
+                                         json={"molecules": molecules, "task_type": task_type})
+            response.raise_for_status()
+            results = {r['molecule_id']: r for r in response.json()}
+
+            if results["ETHANOL"]["status"] != "success":
+                self.print_result(False, error="有效分子受到同批次無效分子影響")
+                return False
+            for mol_id, _, expected in cases:
+                row = results[mol_id]
+                if row["status"] != "error" or expected not in (row.get("error_message") or ""):
+                    self.print_result(False, error=f"{mol_id} 應以「{expected}」拒絕，實際: {row.get('error_message')}")
+                    return False
+
+            # 單一預測也回傳同樣的原因
+            single = self.test_single_prediction("UNPARSEABLE", "C1CC", task_type)
+            if not single or single["status"] != "error" or not single.get("error_message"):
+                self.print_result(False, error="單一預測未回傳拒絕原因")
+                return False
+            self.print_result(True, [results[mol_id] for mol_id, _, _ in cases])
+            return True
+        except Exception as e:
+            self.print_result(False, error=str(e))
+            return False
+
+    def test_content_negotiation(self, task_type: str):
+        """測試 Accept 協商：不支援的格式回傳 406，欄式 JSON 與 MessagePack 內容與 JSON 一致"""
+        self.print_test_header("回應格式協商")
+        molecules = [
+            {"molecule_id": "ETHANOL", "smiles": "CCO"},
+            {"molecule_id": "METHANOL", "smiles": "CO"},
+            {"molecule_id": "UNPARSEABLE", "smiles": "C1CC"}
+        ]
+        data = {"molecules": molecules, "task_type": task_type}
+        url = f"{self.base_url}/predict/batch"
+        try:
+            response = self.session.post(url, json=data, headers={"Accept": "application/xml"})
+            if response.status_code != 406:
+                self.print_result(False, error=f"不支援的格式應回傳 406，實際為 {response.status_code}")
+                return False
+
+            rows = self.session.post(url, json=data, headers={"Accept": "application/json"}).json()
+
+            response = self.session.post(url, json=data,
+                                         headers={"Accept": "application/vnd.ssl-gcn.columnar+json"})
+            response.raise_for_status()
+            columns = response.json()
+            if not isinstance(columns, dict) or set(columns) != set(rows[0]):
+                self.print_result(False, error=f"欄式回應的欄位不符: {columns}")
+                return False
+            if any(len(values) != len(rows) for values in columns.values()):
+                self.print_result(False, error="欄式回應各欄長度不一致")
+                return False
+            if columns["molecule_id"] != [r["molecule_id"] for r in rows] or \
+                    columns["status"] != [r["status"] for r in rows]:
+                self.print_result(False, error="欄式回應與 JSON 回應內容不同")
+                return False
+
+            try:
+                import msgpack
+            except ImportError:
+                print("⚠️  未安裝 msgpack，略過 MessagePack 驗證")
+            else:
+                response = self.session.post(url, json=data, headers={"Accept": "application/msgpack"})
+                response.raise_for_status()
+                if response.headers.get("content-type") != "application/msgpack":
+                    self.print_result(False, error=f"Content-Type 不符: {response.headers.get('content-type')}")
+                    return False
+                if msgpack.unpackb(response.content, raw=False) != rows:
+                    self.print_result(False, error="MessagePack 回應與 JSON 回應內容不同")
+                    return False
+
+            self.print_result(True, columns)
+            return True
+        except Exception as e:
+            self.print_result(False, error=str(e))
+            return False
+
+    def test_scheduler_interleaving(self, task_type: str, n_bulk: int = 2000):
+        """測試准入排程：大批次執行期間送出的單一預測走互動通道，並在大批次完成前回應"""
+        self.print_test_header(f"准入排程 - {n_bulk} 個分子的批次與單一預測交錯")
+        bulk_molecules = [{"molecule_id": f"BULK{i}", "smiles": "CC(=O)OC1=CC=CC=C1C(=O)O"}
+                          for i in range(n_bulk)]
+        outcome = {}
+
+        def run_bulk():
+            # 獨立連線，避免與單一預測共用 Session
+            response = requests.post(f"{self.base_url}/predict/batch",
+                                     json={"molecules": bulk_molecules, "task_type": task_type})
+            outcome["bulk"] = (response, time.perf_counter())
+
+        try:
+            worker = threading.Thread(target=run_bulk)
+            worker.start()
+            time.sleep(0.5)
+            response = self.session.post(f"{self.base_url}/predict/single", json={
+                "molecule_id": "ETHANOL", "smiles": "CCO", "task_type": task_type})
+            single_done = time.perf_counter()
+            health = self.session.get(f"{self.base_url}/health", timeout=3)
+            worker.join()
+            response.raise_for_status()
+            health.raise_for_status()
+
+            bulk_response, bulk_done = outcome["bulk"]
+            bulk_response.raise_for_status()
+            lanes = (response.headers.get("X-Scheduler-Lane"), bulk_response.headers.get("X-Scheduler-Lane"))
+            if lanes != ("interactive", "bulk"):
+                self.print_result(False, error=f"通道分類不符: 單一 {lanes[0]}，批次 {lanes[1]}")
+                return False
+            if single_done >= bulk_done:
+                self.print_result(False, error="單一預測未插在批次切片之間，等到整個批次完成才回應")
+                return False
+            if [r["molecule_id"] for r in bulk_response.json()] != [m["molecule_id"] for m in bulk_molecules]:
+                self.print_result(False, error="切片合併後的順序與輸入不符")
+                return False
+            self.print_result(True, {
+                "single_queue_wait_ms": response.headers.get("X-Queue-Wait-Ms"),
+                "bulk_queue_wait_ms": bulk_response.headers.get("X-Queue-Wait-Ms"),
+                "single_before_bulk_ms": round((bulk_done - single_done) * 1000, 1)
+            })
+            return True
+        except Exception as e:
+            self.print_result(False, error=str(e))
+            return False
+
     def test_error_handling(self):
         """測試錯誤處理"""
         self.print_test_header("錯誤處理測試")
@@ -238,6 +429,26 @@ class SSLGCNAPITester:
                     tests_passed += 1
                 total_tests += 1
         
+            # 分子前置篩檢
+            total_tests += 1
+            if self.test_screen_rejections(supported_tasks[0]):
+                tests_passed += 1
+
+            # 回應格式協商
+            total_tests += 1
+            if self.test_content_negotiation(supported_tasks[0]):
+                tests_passed += 1
+
+            # 准入排程
+            total_tests += 1
+            if self.test_scheduler_interleaving(supported_tasks[0]):
+                tests_passed += 1
+
+            # 結果庫查詢
+            total_tests += 1
+            if self.test_lookup(supported_tasks[:3]):
+                tests_passed += 1
+
         # 錯誤處理測試
         self.test_error_handling()
         
@@ -255,7 +466,7 @@ class SSLGCNAPITester:
 
 if __name__ == "__main__":
     # 運行測試
-    tester = SSLGCNAPITester()
+    tester = SSLGCNAPITester(admin_token=os.environ.get("SSL_GCN_ADMIN_TOKEN"))
     passed, total = tester.run_comprehensive_test()
     
     # 退出碼
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSL-GCN 打包圖一致性測試腳本
+驗證 PackedGraphs 切片重建的批次圖與 dgl.batch 相同，且模型輸出一致
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+from functools import partial
+
+import dgl
+import torch
+import numpy as np
+from dgllife.utils import smiles_to_bigraph, CanonicalAtomFeaturizer
+
+# 添加項目根目錄到Python路徑
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(ROOT)
+
+from dataset import PackedGraphs
+from utils import get_self_configure, load_model
+
+class PackingTester:
+    def __init__(self, fasta_path: str = os.path.join(ROOT, "test_data.fasta"),
+                 model_root: str = os.path.join(ROOT, "model"), batch_size: int = 7):
+        self.batch_size = batch_size
+        self.model_root = model_root
+        with open(fasta_path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        smiles = [lines[flag + 1].strip() for flag in range(0, len(lines) - 1, 2)]
+        to_graph = partial(smiles_to_bigraph, add_self_loop=True, node_featurizer=CanonicalAtomFeaturizer())
+        self.graphs = [g for g in (to_graph(s) for s in smiles) if g is not None]
+
+    def print_test_header(self, test_name: str):
+        """打印測試標題"""
+        print(f"\n{'='*60}")
+        print(f"🧪 測試: {test_name}")
+        print(f"{'='*60}")
+
+    def print_result(self, success: bool, error: str = None):
+        """打印測試結果"""
+        if success:
+            print(f"✅ 成功")
+        else:
+            print(f"❌ 失敗")
+            if error:
+                print(f"錯誤: {error}")
+
+    def _compare(self, expected, actual) -> str:
+        """比較兩個批次圖，回傳第一個差異（相同時為 None）"""
+        if not torch.equal(expected.batch_num_nodes(), actual.batch_num_nodes()):
+            return "batch_num_nodes 不同"
+        if not torch.equal(expected.batch_num_edges(), actual.batch_num_edges()):
+            return "batch_num_edges 不同"
+        for e, a in zip(expected.edges(), actual.edges()):
+            if not torch.equal(e.long(), a.long()):
+                return "邊不同"
+        if not torch.equal(expected.ndata['h'], actual.ndata['h']):
+            return "節點特徵不同"
+        return None
+
+    def _slices(self, packed):
+        for start in range(0, len(self.graphs), self.batch_size):
+            stop = min(start + self.batch_size, len(self.graphs))
+            yield start, stop, packed.slice(start, stop).to_dgl()
+
+    def test_batched_graphs(self, packed) -> bool:
+        """切片重建的批次圖與 dgl.batch 相同"""
+        for start, stop, bg in self._slices(packed):
+            error = self._compare(dgl.batch(self.graphs[start:stop]), bg)
+            if error:
+                self.print_result(False, error=f"分子 {start}-{stop}: {error}")
+                return False
+        self.print_result(True)
+        return True
+
+    def test_logits(self, packed, task: str) -> bool:
+        """同一模型對兩種批次圖的輸出一致"""
+        args = {'model': 'GCN', 'n_tasks': 1,
+                'atom_featurizer_type': 'canonical', 'bond_featurizer_type': 'canonical'}
+        exp_config = get_self_configure(os.path.join(self.model_root, task, 'configure.json'))
+        exp_config.update(args)
+        model = load_model(exp_config)
+        model.load_state_dict(torch.load(os.path.join(self.model_root, task, 'model.pth'),
+                                         map_location='cpu')['model_state_dict'])
+        model.eval()
+        with torch.no_grad():
+            for start, stop, bg in self._slices(packed):
+                expected_bg = dgl.batch(self.graphs[start:stop])
+                expected = model(expected_bg, expected_bg.ndata['h'])
+                actual = model(bg, bg.ndata['h'])
+                if not torch.allclose(expected, actual, atol=1e-6):
+                    self.print_result(False, error=f"分子 {start}-{stop}: 最大差異 {(expected - actual).abs().max():.3g}")
+                    return False
+        self.print_result(True)
+        return True
+
+    def run_comprehensive_test(self):
+        """運行全面測試"""
+        print(f"🚀 開始打包圖一致性測試（{len(self.graphs)} 個分子，批次 {self.batch_size}）")
+        tests_passed = 0
+        total_tests = 0
+        packed = PackedGraphs.from_graphs(self.graphs)
+
+        self.print_test_header("from_graphs 切片 → to_dgl")
+        total_tests += 1
+        if self.test_batched_graphs(packed):
+            tests_passed += 1
+
+        self.print_test_header("save → load（記憶體映射）切片 → to_dgl")
+        temp_dir = tempfile.mkdtemp()
+        try:
+            packed.save(temp_dir, valid_ids=np.arange(len(self.graphs)))
+            loaded, _ = PackedGraphs.load(temp_dir)
+            total_tests += 1
+            if self.test_batched_graphs(loaded):
+                tests_passed += 1
+        finally:
+            shutil.rmtree(temp_dir)
+
+        tasks = sorted(t for t in os.listdir(self.model_root)
+                       if os.path.exists(os.path.join(self.model_root, t, 'model.pth')))
+        for task in tasks[:3]:
+            self.print_test_header(f"模型輸出一致 - {task}")
+            total_tests += 1
+            if self.test_logits(packed, task):
+                tests_passed += 1
+
+        self.print_test_header("測試總結")
+        print(f"📊 通過測試: {tests_passed}/{total_tests}")
+        return tests_passed, total_tests
+
+if __name__ == "__main__":
+    tester = PackingTester()
+    passed, total = tester.run_comprehensive_test()
+
+    # 退出碼
+    exit(0 if passed == total else 1)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSL-GCN 分片路由測試腳本
+驗證一致性雜湊的重新平衡比例，以及路由的分片合併與故障處理（以模擬副本執行，不需啟動服務）
+"""
+
+import os
+import sys
+import json
+import asyncio
+
+# 添加項目根目錄到Python路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from microservice.router.ring import ConsistentHashRing
+
+class RouterTester:
+    def __init__(self, n_keys: int = 20000):
+        self.keys = [f"molecule-{i}" for i in range(n_keys)]
+
+    def print_test_header(self, test_name: str):
+        """打印測試標題"""
+        print(f"\n{'='*60}")
+        print(f"🧪 測試: {test_name}")
+        print(f"{'='*60}")
+
+    def print_result(self, success: bool, message: str = None, error: str = None):
+        """打印測試結果"""
+        if success:
+            print(f"✅ 成功")
+            if message:
+                print(message)
+        else:
+            print(f"❌ 失敗")
+            if error:
+                print(f"錯誤: {error}")
+        return success
+
+    def test_ring_join(self) -> bool:
+        """加入第 4 個副本時只有約 1/4 的鍵搬移，且全部搬到新副本"""
+        self.print_test_header("一致性雜湊 - 副本加入")
+        ring = ConsistentHashRing(['http://r1', 'http://r2', 'http://r3'])
+        before = {key: ring.node_for(key) for key in self.keys}
+        ring.add('http://r4')
+        moved = [key for key in self.keys if ring.node_for(key) != before[key]]
+        fraction = len(moved) / len(self.keys)
+        if any(ring.node_for(key) != 'http://r4' for key in moved):
+            return self.print_result(False, error="有鍵搬移到既有副本之間")
+        if not 0.15 <= fraction <= 0.35:
+            return self.print_result(False, error=f"搬移比例 {fraction:.1%} 偏離預期的 25%")
+        return self.print_result(True, f"搬移比例: {fraction:.1%}")
+
+    def test_ring_leave(self) -> bool:
+        """副本離開時只有該副本的鍵搬移"""
+        self.print_test_header("一致性雜湊 - 副本離開")
+        ring = ConsistentHashRing(['http://r1', 'http://r2', 'http://r3', 'http://r4'])
+        before = {key: ring.node_for(key) for key in self.keys}
+        ring.remove('http://r2')
+        moved = [key for key in self.keys if ring.node_for(key) != before[key]]
+        if any(before[key] != 'http://r2' for key in moved):
+            return self.print_result(False, error="非離開副本的鍵被搬移")
+        if len(moved) != sum(1 for node in before.values() if node == 'http://r2'):
+            return self.print_result(False, error="離開副本的鍵未全部搬移")
+        return self.print_result(True, f"搬移鍵數: {len(moved)}")
+
+    def test_ring_balance(self) -> bool:
+        """虛擬節點使各副本負載接近平均"""
+        self.print_test_header("一致性雜湊 - 負載分布")
+        ring = ConsistentHashRing(['http://r1', 'http://r2', 'http://r3', 'http://r4'])
+        counts = {}
+        for key in self.keys:
+            node = ring.node_for(key)
+            counts[node] = counts.get(node, 0) + 1
+        worst = max(counts.values()) / (len(self.keys) / len(counts))
+        if worst > 1.3:
+            return self.print_result(False, error=f"最大負載為平均的 {worst:.2f} 倍")
+        return self.print_result(True, f"各副本鍵數: {counts}")
+
+    def test_fanout(self) -> bool:
+        """分片合併維持原始順序；連線失敗改派，讀取逾時不移出副本也不重送，缺列時回傳 502"""
+        self.print_test_header("路由分片合併與故障處理（模擬副本）")
+        import httpx
+        from fastapi import HTTPException
+        from starlette.requests import Request
+        from microservice.router import app as router
+
+        calls = {}
+        behaviour = {}
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            replica = f"{request.url.scheme}://{request.url.host}"
+            calls.setdefault(replica, []).extend(
+                mol['molecule_id'] for mol in json.loads(request.content)['molecules'])
+            if behaviour.get(replica) == 'down':
+                raise httpx.ConnectError("connection refused", request=request)
+            if behaviour.get(replica) == 'slow':
+                raise httpx.ReadTimeout("read timed out", request=request)
+            rows = [{'molecule_id': mol['molecule_id'], 'smiles': mol['smiles'], 'status': 'success',
+                     'replica': replica} for mol in json.loads(request.content)['molecules']]
+            if behaviour.get(replica) == 'short':
+                rows = rows[:-1]
+            # 副本回傳順序與送出順序不同
+            return httpx.Response(200, json=rows[::-1], headers={'x-queue-wait-ms': str(len(rows))})
+
+        molecules = [{'molecule_id': f"MOL{i}", 'smiles': 'C' * (i % 9 + 1) + 'O' * (i % 5)} for i in range(60)]
+        http_request = Request({'type': 'http', 'headers': [], 'client': ('127.0.0.1', 1234)})
+
+        async def fanout():
+            return await router._fanout('/predict/batch', {'task_type': 'NR-AR', 'molecules': molecules},
+                                        molecules, http_request)
+
+        async def run():
+            router.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            try:
+                for replica in ('http://a', 'http://b', 'http://c'):
+                    router.ring.add(replica)
+
+                results, max_wait, served = await fanout()
+                if [r['molecule_id'] for r in results] != [m['molecule_id'] for m in molecules]:
+                    return "合併後順序或 molecule_id 與輸入不符"
+                if served != {'http://a', 'http://b', 'http://c'}:
+                    return f"實際處理的副本不符: {served}"
+
+                calls.clear()
+                behaviour['http://c'] = 'down'
+                results, _, served = await fanout()
+                if 'http://c' in router.ring.nodes or 'http://c' in served:
+                    return "無法連線的副本未移出雜湊環"
+                if [r['molecule_id'] for r in results] != [m['molecule_id'] for m in molecules]:
+                    return "改派後順序或 molecule_id 與輸入不符"
+
+                calls.clear()
+                behaviour['http://b'] = 'slow'
+                try:
+                    await fanout()
+                    return "讀取逾時未讓請求失敗"
+                except HTTPException as e:
+                    if e.status_code != 504:
+                        return f"讀取逾時的狀態碼應為 504，實際為 {e.status_code}"
+                if 'http://b' not in router.ring.nodes:
+                    return "忙碌副本被移出雜湊環"
+                resent = set(calls.get('http://b', [])) & set(calls.get('http://a', []))
+                if resent:
+                    return "逾時副本的分子被重送到其他副本"
+
+                behaviour['http://b'] = None
+                behaviour['http://a'] = 'short'
+                try:
+                    await fanout()
+                    return "副本少回傳分子時未讓請求失敗"
+                except HTTPException as e:
+                    if e.status_code != 502:
+                        return f"副本少回傳分子的狀態碼應為 502，實際為 {e.status_code}"
+                return None
+            finally:
+                await router.http_client.aclose()
+
+        error = asyncio.run(run())
+        if error:
+            return self.print_result(False, error=error)
+        return self.print_result(True)
+
+    def run_comprehensive_test(self):
+        """運行全面測試"""
+        print("🚀 開始分片路由測試")
+        tests = [self.test_ring_join, self.test_ring_leave, self.test_ring_balance, self.test_fanout]
+        tests_passed = sum(1 for test in tests if test())
+        total_tests = len(tests)
+
+        self.print_test_header("測試總結")
+        print(f"📊 通過測試: {tests_passed}/{total_tests}")
+        return tests_passed, total_tests
+
+if __name__ == "__main__":
+    tester = RouterTester()
+    passed, total = tester.run_comprehensive_test()
+
+    # 退出碼
+    exit(0 if passed == total else 1)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSL-GCN 准入排程器測試腳本
+驗證互動請求插在批量切片之間、切片取消與佇列等待時間（以模擬工作執行，不需模型）
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+# 添加項目根目錄到Python路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from microservice.core.scheduler import AdmissionScheduler, INTERACTIVE, BULK
+
+class SchedulerTester:
+    def __init__(self, slice_seconds: float = 0.02):
+        # 每個模擬切片佔用工作執行緒的時間
+        self.slice_seconds = slice_seconds
+
+    def print_test_header(self, test_name: str):
+        """打印測試標題"""
+        print(f"\n{'='*60}")
+        print(f"🧪 測試: {test_name}")
+        print(f"{'='*60}")
+
+    def print_result(self, success: bool, message: str = None, error: str = None):
+        """打印測試結果"""
+        if success:
+            print(f"✅ 成功")
+            if message:
+                print(message)
+        else:
+            print(f"❌ 失敗")
+            if error:
+                print(f"錯誤: {error}")
+        return success
+
+    def _molecules(self, n: int, prefix: str = "MOL"):
+        return [{'molecule_id': f"{prefix}{i}", 'smiles': 'CCO'} for i in range(n)]
+
+    def _scheduler(self) -> AdmissionScheduler:
+        # 每個 CCO 成本為 4：批量請求每 10 個分子一片
+        return AdmissionScheduler(slice_cost=40, bulk_threshold=40, interactive_weight=1)
+
+    def _work(self, log: list, name: str):
+        def fn(molecules):
+            log.append(name)
+            time.sleep(self.slice_seconds)
+            return [mol['molecule_id'] for mol in molecules]
+        return fn
+
+    def test_split(self) -> bool:
+        """切片不超過成本上限，且每片至少 min_slice 個分子"""
+        self.print_test_header("切片大小")
+        scheduler = self._scheduler()
+        molecules = self._molecules(95)
+        slices = scheduler.split(molecules)
+        if [len(s) for s in slices] != [10] * 9 + [5]:
+            return self.print_result(False, error=f"切片大小不符: {[len(s) for s in slices]}")
+        slices = scheduler.split(molecules, min_slice=32)
+        if [len(s) for s in slices] != [32, 32, 31]:
+            return self.print_result(False, error=f"min_slice 未生效: {[len(s) for s in slices]}")
+        if [m for s in slices for m in s] != molecules:
+            return self.print_result(False, error="切片後順序改變")
+        return self.print_result(True, f"切片數: {len(scheduler.split(molecules))} / min_slice=32: {len(slices)}")
+
+    def test_interleaving(self) -> bool:
+        """批量請求執行中到達的互動請求，在下一個切片前執行且合併結果維持原順序"""
+        self.print_test_header("互動請求插入批量切片之間")
+        scheduler = self._scheduler()
+        log = []
+
+        async def run():
+            bulk = asyncio.ensure_future(scheduler.run('bulk-client', self._molecules(100),
+                                                       self._work(log, 'bulk')))
+            # 等第一個切片開始執行；事件迴圈此時必須仍可回應
+            await asyncio.sleep(self.slice_seconds / 2)
+            arrived = time.perf_counter()
+            results, wait, lane = await scheduler.run('interactive-client', self._molecules(1, "SINGLE"),
+                                                      self._work(log, 'single'), interactive=True)
+            latency = time.perf_counter() - arrived
+            bulk_results, _, bulk_lane = await bulk
+            await scheduler.stop()
+            return results, lane, latency, bulk_results, bulk_lane
+
+        results, lane, latency, bulk_results, bulk_lane = asyncio.run(run())
+        if lane != INTERACTIVE or bulk_lane != BULK:
+            return self.print_result(False, error=f"通道分類不符: {lane}, {bulk_lane}")
+        if 'single' not in log or log.index('single') > 2:
+            return self.print_result(False, error=f"互動請求未插在批量切片之間: {log}")
+        if latency > 3 * self.slice_seconds:
+            return self.print_result(False, error=f"互動請求延遲 {latency * 1000:.1f}ms 超過兩個切片")
+        if bulk_results != [f"MOL{i}" for i in range(100)] or results != ["SINGLE0"]:
+            return self.print_result(False, error="合併後結果順序不符")
+        return self.print_result(True, f"執行順序: {log[:4]} ...，互動延遲 {latency * 1000:.1f}ms")
+
+    def test_queue_wait(self) -> bool:
+        """切片執行期間入列的請求，回報的佇列等待涵蓋等待工作執行緒的時間"""
+        self.print_test_header("佇列等待時間")
+        scheduler = self._scheduler()
+        log = []
+
+        async def run():
+            first = asyncio.ensure_future(scheduler.run('a', self._molecules(5), self._work(log, 'a')))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(scheduler.run('b', self._molecules(5), self._work(log, 'b')))
+            (_, wait_a, _), (_, wait_b, _) = await asyncio.gather(first, second)
+            await scheduler.stop()
+            return wait_a, wait_b
+
+        wait_a, wait_b = asyncio.run(run())
+        if wait_b < 0.8 * self.slice_seconds:
+            return self.print_result(False, error=f"第二個請求的等待 {wait_b * 1000:.1f}ms 少於前一個工作的執行時間")
+        return self.print_result(True, f"等待時間: {wait_a * 1000:.1f}ms / {wait_b * 1000:.1f}ms")
+
+    def test_cancellation(self) -> bool:
+        """切片失敗或請求取消時，尚未執行的切片不再執行"""
+        self.print_test_header("切片取消")
+        scheduler = self._scheduler()
+        log = []
+
+        def failing(molecules):
+            log.append('fail')
+            time.sleep(self.slice_seconds)
+            raise RuntimeError("slice failed")
+
+        async def run():
+            try:
+                await scheduler.run('client', self._molecules(50), failing)
+                return "切片失敗未讓請求失敗"
+            except RuntimeError:
+                pass
+            await asyncio.sleep(3 * self.slice_seconds)
+            if log != ['fail']:
+                return f"失敗後仍執行了其餘切片: {log}"
+
+            log.clear()
+            task = asyncio.ensure_future(scheduler.run('client', self._molecules(50), self._work(log, 'bulk')))
+            await asyncio.sleep(self.slice_seconds / 2)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            await asyncio.sleep(3 * self.slice_seconds)
+            if len(log) > 1:
+                return f"取消後仍執行了 {len(log)} 個切片"
+            if any(lane['queued_jobs'] for lane in scheduler.stats()['lanes'].values()):
+                return "佇列中殘留已取消的切片"
+            await scheduler.stop()
+            return None
+
+        error = asyncio.run(run())
+        if error:
+            return self.print_result(False, error=error)
+        return self.print_result(True)
+
+    def run_comprehensive_test(self):
+        """運行全面測試"""
+        print("🚀 開始准入排程器測試")
+        tests = [self.test_split, self.test_interleaving, self.test_queue_wait, self.test_cancellation]
+        tests_passed = sum(1 for test in tests if test())
+        total_tests = len(tests)
+
+        self.print_test_header("測試總結")
+        print(f"📊 通過測試: {tests_passed}/{total_tests}")
+        return tests_passed, total_tests
+
+if __name__ == "__main__":
+    tester = SchedulerTester()
+    passed, total = tester.run_comprehensive_test()
+
+    # 退出碼
+    exit(0 if passed == total else 1)
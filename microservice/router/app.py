@@ -0,0 +1,285 @@
+#coding=utf-8
+from fastapi import FastAPI, HTTPException, Header, Request, Depends
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any, Set, Tuple
+import asyncio
+import uvicorn
+import httpx
+import os
+import sys
+
+# 添加項目根目錄到Python路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from microservice.core.prediction_store import canonicalize_smiles
+from microservice.router.ring import ConsistentHashRing
+from microservice.api import serialization
+
+app = FastAPI(
+    title="SSL-GCN 分片路由",
+    description="依標準 SMILES 一致性雜湊，將批次請求分派到多個預測服務副本",
+    version="1.0.0",
+    docs_url="/docs",
+    redoc_url="/redoc"
+)
+
+# 副本位址（逗號分隔），例如 http://127.0.0.1:8008,http://127.0.0.1:8009
+CONFIGURED_REPLICAS = [url.strip().rstrip('/') for url in os.environ.get('SSL_GCN_REPLICAS', '').split(',') if url.strip()]
+HEALTH_INTERVAL = float(os.environ.get('SSL_GCN_ROUTER_HEALTH_INTERVAL', '5'))
+HEALTH_TIMEOUT = float(os.environ.get('SSL_GCN_ROUTER_HEALTH_TIMEOUT', '10'))
+# 連續幾次健康檢查失敗才移出雜湊環（忙碌的副本可能短暫無法回應）
+HEALTH_FAILURES = int(os.environ.get('SSL_GCN_ROUTER_HEALTH_FAILURES', '3'))
+REQUEST_TIMEOUT = float(os.environ.get('SSL_GCN_ROUTER_TIMEOUT', '300'))
+CONNECT_TIMEOUT = float(os.environ.get('SSL_GCN_ROUTER_CONNECT_TIMEOUT', '5'))
+ADMIN_TOKEN = os.environ.get('SSL_GCN_ADMIN_TOKEN')
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+# 轉送給副本的標頭（維持副本端的客戶公平排程與剖析）
+FORWARDED_HEADERS = ('x-api-key', 'x-client-id', 'x-profile')
+
+# 已知副本（含啟動後加入者）與目前健康、參與分片的雜湊環
+known_replicas = set(CONFIGURED_REPLICAS)
+ring = ConsistentHashRing(CONFIGURED_REPLICAS)
+# 副本 -> 連續健康檢查失敗次數
+health_failures: Dict[str, int] = {}
+http_client: Optional[httpx.AsyncClient] = None
+_health_task: Optional[asyncio.Task] = None
+
+# 與 microservice.api.app 的回應模型欄位一致
+PREDICTION_FIELDS = ['molecule_id', 'smiles', 'prediction', 'confidence', 'status', 'error_message']
+LOOKUP_FIELDS = ['molecule_id', 'smiles', 'canonical_smiles', 'predictions', 'status', 'error_message']
+EMBED_FIELDS = ['molecule_id', 'smiles', 'canonical_smiles', 'embeddings', 'status', 'error_message']
+
+class ReplicaRequest(BaseModel):
+    url: str
+
+class ReplicaUnavailableError(Exception):
+    """沒有可用的副本"""
+
+class ReplicaDownError(Exception):
+    """無法建立連線：請求未送達副本，可安全改派"""
+
+def _check_admin(http_request: Request, x_admin_token: Optional[str] = Header(None)) -> None:
+    """管理端點權限：設定 SSL_GCN_ADMIN_TOKEN 時需附上相符的 X-Admin-Token；
+    未設定時只接受本機（loopback）請求，避免任何客戶端都能調整剖析或副本設定"""
+    if ADMIN_TOKEN:
+        if x_admin_token != ADMIN_TOKEN:
+            raise HTTPException(status_code=403, detail="管理權杖無效")
+    elif not (http_request.client and http_request.client.host in LOOPBACK_HOSTS):
+        raise HTTPException(status_code=403, detail="未設定 SSL_GCN_ADMIN_TOKEN 時管理端點僅限本機存取")
+
+def _negotiate(accept: Optional[str]) -> str:
+    try:
+        return serialization.negotiate(accept)
+    except serialization.NotAcceptableError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+def _forward_headers(http_request: Request) -> Dict[str, str]:
+    headers = {name: http_request.headers[name] for name in FORWARDED_HEADERS if name in http_request.headers}
+    if 'x-api-key' not in headers and 'x-client-id' not in headers and http_request.client:
+        headers['x-client-id'] = http_request.client.host
+    headers['accept'] = serialization.JSON_MEDIA_TYPE
+    return headers
+
+def _shard_key(smiles: str) -> str:
+    """以標準 SMILES 分片，讓同一分子的不同寫法落在同一副本；無法解析時使用原字串"""
+    return canonicalize_smiles(smiles) or smiles
+
+async def _send(replica: str, path: str, payload: Dict[str, Any], headers: Dict[str, str]) -> httpx.Response:
+    """轉送請求至副本
+
+    只有無法建立連線時才將副本移出雜湊環並拋出 ReplicaDownError（請求未送達，可改派）。
+    讀取逾時、連線中斷或 5xx 時副本可能仍在處理，視為該請求失敗而非成員變更，不重送。
+    """
+    try:
+        response = await http_client.post(replica + path, json=payload, headers=headers)
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        ring.remove(replica)
+        raise ReplicaDownError(replica) from e
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"副本 {replica} 回應逾時: {str(e)}")
+    except httpx.TransportError as e:
+        raise HTTPException(status_code=502, detail=f"副本 {replica} 連線中斷: {str(e)}")
+    if response.status_code >= 500:
+        raise HTTPException(status_code=502, detail=f"副本 {replica} 錯誤 {response.status_code}: {response.text}")
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.json().get('detail'))
+    return response
+
+async def _fanout(path: str, body: Dict[str, Any], molecules: List[Dict[str, str]],
+                  http_request: Request) -> Tuple[List[Dict[str, Any]], float, Set[str]]:
+    """依分片鍵把分子分組送到各副本並行處理，再依原始順序合併
+
+    送出前把 molecule_id 改寫為原始位置，回來後再還原，因此副本的回傳順序不影響合併結果。
+    無法連線的副本會被移出雜湊環，該組分子改派其他副本；副本回傳的列與送出的分子不符時回傳 502。
+    回傳 (結果, 最長佇列等待毫秒, 實際處理的副本)。
+    """
+    # RDKit 標準化是 CPU 工作，移到執行緒池以免阻塞事件迴圈（健康檢查與其他請求）
+    keys = await asyncio.get_event_loop().run_in_executor(
+        None, lambda: [_shard_key(mol['smiles']) for mol in molecules])
+    headers = _forward_headers(http_request)
+    merged: List[Optional[Dict[str, Any]]] = [None] * len(molecules)
+    pending = list(range(len(molecules)))
+    max_wait = 0.0
+    served: Set[str] = set()
+
+    while pending:
+        groups: Dict[str, List[int]] = {}
+        for i in pending:
+            replica = ring.node_for(keys[i])
+            if replica is None:
+                raise ReplicaUnavailableError("沒有可用的預測服務副本")
+            groups.setdefault(replica, []).append(i)
+
+        replicas = list(groups)
+        outcomes = await asyncio.gather(*[
+            _send(replica, path,
+                  dict(body, molecules=[{'molecule_id': str(i), 'smiles': molecules[i]['smiles']} for i in groups[replica]]),
+                  headers)
+            for replica in replicas
+        ], return_exceptions=True)
+
+        pending = []
+        error = None
+        for replica, outcome in zip(replicas, outcomes):
+            if isinstance(outcome, ReplicaDownError):
+                pending.extend(groups[replica])
+                continue
+            if isinstance(outcome, BaseException):
+                error = error or outcome
+                continue
+            served.add(replica)
+            max_wait = max(max_wait, float(outcome.headers.get('x-queue-wait-ms', 0)))
+            expected = set(groups[replica])
+            for row in outcome.json():
+                i = int(row['molecule_id']) if str(row.get('molecule_id')).isdigit() else None
+                if i not in expected:
+                    error = error or HTTPException(
+                        status_code=502, detail=f"副本 {replica} 回傳了未送出或重複的分子: {row.get('molecule_id')}")
+                    continue
+                expected.discard(i)
+                row['molecule_id'] = molecules[i]['molecule_id']
+                merged[i] = row
+            if expected:
+                error = error or HTTPException(
+                    status_code=502, detail=f"副本 {replica} 只回傳 {len(groups[replica]) - len(expected)}/{len(groups[replica])} 個分子")
+        if error is not None:
+            raise error
+    return merged, max_wait, served
+
+async def _route_batch(path: str, body: Dict[str, Any], fields: List[str],
+                       http_request: Request, accept: Optional[str]):
+    media_type = _negotiate(accept)
+    molecules = body.get('molecules') or []
+    if not molecules:
+        raise HTTPException(status_code=400, detail="分子列表不能為空")
+    try:
+        results, max_wait, served = await _fanout(path, body, molecules, http_request)
+    except ReplicaUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    response = serialization.render(results, fields, media_type)
+    response.headers["X-Queue-Wait-Ms"] = f"{max_wait:.1f}"
+    response.headers["X-Replicas"] = str(len(served))
+    return response
+
+async def _check_replica(replica: str) -> None:
+    try:
+        healthy = (await http_client.get(replica + '/health', timeout=HEALTH_TIMEOUT)).status_code == 200
+    except httpx.HTTPError:
+        healthy = False
+    if healthy:
+        health_failures[replica] = 0
+        ring.add(replica)
+    else:
+        health_failures[replica] = health_failures.get(replica, 0) + 1
+        if health_failures[replica] >= HEALTH_FAILURES:
+            ring.remove(replica)
+
+async def _health_loop() -> None:
+    """定期檢查已知副本：健康者加入雜湊環，連續 HEALTH_FAILURES 次失敗者移出"""
+    while True:
+        await asyncio.gather(*[_check_replica(replica) for replica in list(known_replicas)])
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+@app.on_event("startup")
+async def start_router():
+    global http_client, _health_task
+    http_client = httpx.AsyncClient(timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT))
+    _health_task = asyncio.get_event_loop().create_task(_health_loop())
+
+@app.on_event("shutdown")
+async def stop_router():
+    if _health_task is not None:
+        _health_task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+
+@app.get("/health")
+async def health_check():
+    """健康檢查端點（至少一個副本可用時為 healthy）"""
+    return {
+        "status": "healthy" if len(ring) else "degraded",
+        "message": f"{len(ring)}/{len(known_replicas)} 個副本可用",
+        "version": "1.0.0"
+    }
+
+@app.post("/predict/single")
+async def predict_single(request: Request):
+    """單一分子預測：依分片鍵轉送至對應副本（無法連線時改派下一個副本）"""
+    body = await request.json()
+    key = _shard_key(body.get('smiles', ''))
+    headers = _forward_headers(request)
+    while True:
+        replica = ring.node_for(key)
+        if replica is None:
+            raise HTTPException(status_code=503, detail="沒有可用的預測服務副本")
+        try:
+            response = await _send(replica, '/predict/single', body, headers)
+        except ReplicaDownError:
+            continue
+        return JSONResponse(response.json(), headers={"X-Queue-Wait-Ms": response.headers.get('x-queue-wait-ms', '0')})
+
+@app.post("/predict/batch")
+async def predict_batch(request: Request, accept: Optional[str] = Header(None)):
+    """批次分子預測：依標準 SMILES 分片到各副本並行處理"""
+    return await _route_batch('/predict/batch', await request.json(), PREDICTION_FIELDS, request, accept)
+
+@app.post("/predict/lookup")
+async def predict_lookup(request: Request, accept: Optional[str] = Header(None)):
+    """多端點結果庫查詢：分片後同一分子固定落在同一副本，提高快取命中率"""
+    return await _route_batch('/predict/lookup', await request.json(), LOOKUP_FIELDS, request, accept)
+
+@app.post("/embed")
+async def embed_batch(request: Request, accept: Optional[str] = Header(None)):
+    """圖嵌入擷取：依標準 SMILES 分片"""
+    return await _route_batch('/embed', await request.json(), EMBED_FIELDS, request, accept)
+
+@app.get("/router/replicas", response_model=Dict[str, List[str]], dependencies=[Depends(_check_admin)])
+async def list_replicas():
+    """列出已知副本與目前參與分片的副本"""
+    return {"known": sorted(known_replicas), "active": ring.nodes}
+
+@app.post("/router/replicas", response_model=Dict[str, List[str]], dependencies=[Depends(_check_admin)])
+async def join_replica(request: ReplicaRequest):
+    """加入副本；一致性雜湊只會搬移其負責區段的分子"""
+    url = request.url.rstrip('/')
+    known_replicas.add(url)
+    health_failures[url] = 0
+    ring.add(url)
+    return {"known": sorted(known_replicas), "active": ring.nodes}
+
+@app.delete("/router/replicas", response_model=Dict[str, List[str]], dependencies=[Depends(_check_admin)])
+async def leave_replica(url: str):
+    """移除副本，其負責的分子改由環上的下一個副本處理"""
+    url = url.rstrip('/')
+    known_replicas.discard(url)
+    health_failures.pop(url, None)
+    ring.remove(url)
+    return {"known": sorted(known_replicas), "active": ring.nodes}
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "microservice.router.app:app",
+        host="0.0.0.0",
+        port=int(os.environ.get('API_PORT', 8007))
+    )
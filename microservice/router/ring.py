@@ -0,0 +1,56 @@
+#coding=utf-8
+import bisect
+import hashlib
+from typing import List, Dict, Iterable, Optional
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """一致性雜湊環：每個副本放置多個虛擬節點，副本加入或離開時只搬移鄰近區段的鍵"""
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 100):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add(self, node: str) -> bool:
+        """加入副本，已存在時回傳 False"""
+        if node in self._nodes:
+            return False
+        self._nodes.add(node)
+        for i in range(self.vnodes):
+            point = _hash(f"{node}#{i}")
+            if point in self._owners:
+                continue
+            bisect.insort(self._points, point)
+            self._owners[point] = node
+        return True
+
+    def remove(self, node: str) -> bool:
+        """移除副本，不存在時回傳 False"""
+        if node not in self._nodes:
+            return False
+        self._nodes.discard(node)
+        self._points = [p for p in self._points if self._owners[p] != node]
+        self._owners = {p: n for p, n in self._owners.items() if n != node}
+        return True
+
+    def node_for(self, key: str) -> Optional[str]:
+        """鍵在環上順時針遇到的第一個副本"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
@@ -0,0 +1,109 @@
+#coding=utf-8
+import os
+import re
+import time
+import signal
+import threading
+from rdkit import Chem, RDLogger
+
+RDLogger.DisableLog('rdApp.*')
+
+# characters that can appear in a SMILES string; anything else is rejected before parsing
+SMILES_CHARS = re.compile(r'^[A-Za-z0-9@+\-\[\]\(\)=#$%/\\.:*~]+$')
+TIMEOUT_REASON = 'featurization exceeded {:.1f}s budget'
+
+
+class FeaturizationTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise FeaturizationTimeout()
+
+
+class MoleculeScreen(object):
+    """Cheap pre-screen run before featurization.
+
+    `check` returns None for an acceptable SMILES string or a rejection reason.
+    `featurize` runs the featurizer under a per-molecule time budget. On the main
+    thread of a POSIX process the budget is enforced with SIGALRM. Elsewhere (e.g.
+    the service's worker thread) the featurizer cannot be interrupted, so the
+    elapsed time is checked afterwards and an over-budget molecule is rejected;
+    the atom and bond limits are what bound the cost there.
+    """
+
+    def __init__(self, max_smiles_length=1000, max_heavy_atoms=200, max_bonds=250, time_budget=2.0):
+        self.max_smiles_length = max_smiles_length
+        self.max_heavy_atoms = max_heavy_atoms
+        self.max_bonds = max_bonds
+        self.time_budget = time_budget
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_smiles_length=int(os.environ.get('SSL_GCN_MAX_SMILES_LENGTH', 1000)),
+                   max_heavy_atoms=int(os.environ.get('SSL_GCN_MAX_HEAVY_ATOMS', 200)),
+                   max_bonds=int(os.environ.get('SSL_GCN_MAX_BONDS', 250)),
+                   time_budget=float(os.environ.get('SSL_GCN_FEATURIZE_TIMEOUT', 2.0)))
+
+    def signature(self):
+        """Identifies the deterministic limits, so cached rejections can be invalidated when they change."""
+        return 'smiles<={:d},atoms<={:d},bonds<={:d}'.format(self.max_smiles_length, self.max_heavy_atoms, self.max_bonds)
+
+    @staticmethod
+    def is_transient(reason):
+        """Time-budget rejections depend on load and should not be cached."""
+        return reason.startswith(TIMEOUT_REASON.split('{')[0])
+
+    def check(self, smiles):
+        return self._parse(smiles)[1]
+
+    def _parse(self, smiles):
+        """Returns (mol, reason); the parsed mol is reused for featurization."""
+        if not smiles:
+            return None, 'empty SMILES'
+        if len(smiles) > self.max_smiles_length:
+            return None, 'SMILES longer than {:d} characters'.format(self.max_smiles_length)
+        if not SMILES_CHARS.match(smiles):
+            return None, 'SMILES contains invalid characters'
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is None:
+            return None, 'unparseable SMILES'
+        if mol.GetNumHeavyAtoms() > self.max_heavy_atoms:
+            return None, '{:d} heavy atoms exceeds limit of {:d}'.format(mol.GetNumHeavyAtoms(), self.max_heavy_atoms)
+        if mol.GetNumBonds() > self.max_bonds:
+            return None, '{:d} bonds exceeds limit of {:d}'.format(mol.GetNumBonds(), self.max_bonds)
+        return mol, None
+
+    def featurize(self, mol_to_graph, smiles, **kwargs):
+        """Returns (graph, reason); graph is None when the molecule is rejected.
+
+        `mol_to_graph` receives the RDKit mol parsed by the screen, so the
+        SMILES string is only parsed once.
+        """
+        mol, reason = self._parse(smiles)
+        if reason is not None:
+            return None, reason
+        use_alarm = self._can_use_alarm()
+        start = time.perf_counter()
+        if use_alarm:
+            previous = signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.time_budget)
+        try:
+            graph = mol_to_graph(mol, **kwargs)
+        except FeaturizationTimeout:
+            return None, TIMEOUT_REASON.format(self.time_budget)
+        except Exception as e:
+            return None, 'featurization error: {}'.format(e)
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+        if graph is None:
+            return None, 'featurization failed'
+        if self.time_budget and self.time_budget > 0 and time.perf_counter() - start > self.time_budget:
+            return None, TIMEOUT_REASON.format(self.time_budget)
+        return graph, None
+
+    def _can_use_alarm(self):
+        return (self.time_budget and self.time_budget > 0 and hasattr(signal, 'setitimer')
+                and threading.current_thread() is threading.main_thread())
@@ -7,7 +7,7 @@ from functools import partial
 import numpy as np
 import pandas as pd
 import torch.nn.functional as F
-from dgllife.utils import smiles_to_bigraph
+from dgllife.utils import smiles_to_bigraph, mol_to_bigraph
 from dataset import Dataset
 
 def init_featurizer(args):
@@ -28,7 +28,9 @@ def load_dataset(args, df):
                      node_featurizer=args['node_featurizer'],
                      edge_featurizer=args['edge_featurizer'],
                      smiles_column=args['smiles_column'],
-                     cache_file_path=args['result_path'] +'/graph.bin')
+                     cache_file_path=args.get('cache_path'),
+                     screen=args.get('screen'),
+                     mol_to_graph=partial(mol_to_bigraph, add_self_loop=True))
     return dataset
 
 def get_self_configure(config_path):
@@ -92,6 +94,13 @@ def predict(args, model, bg):
         edge_feats = bg.edata.pop('e').to(args['device'])
         return model(bg, node_feats, edge_feats)
 
+def embed(args, model, bg):
+    # graph-level readout of a GCNPredictor, i.e. the input of its MLP predictor
+    bg = bg.to(args['device'])
+    node_feats = bg.ndata.pop('h').to(args['device'])
+    node_feats = model.gnn(bg, node_feats)
+    return model.readout(bg, node_feats)
+
 def read_fasta(args, file_path):
     f = open(file_path, 'r', encoding='utf-8')
     fasta_list = np.array(f.readlines())